@@ -0,0 +1,849 @@
+# Benchmarks for bluetooth.py against a fake Pico (no BLE hardware needed)
+#
+#   python benchmark.py ingest --duration 20
+#   python benchmark.py render
+#   python benchmark.py compress
+#   python benchmark.py devices --counts 1,4,16
+#   python benchmark.py metrics
+#   python benchmark.py decode --samples 100000
+#   python benchmark.py rules --rules 50
+#   python benchmark.py sampling --hours 24
+#   python benchmark.py water-off
+#   python benchmark.py startup
+#   python benchmark.py replay --record 10
+#   python benchmark.py load --clients 20 --duration 30 --drop-rate 0.01
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+import urllib.request
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from bisect import bisect_left
+from bleak.exc import BleakError
+
+import bluetooth
+
+
+class FakeBleakClient:
+    """In-process stand-in for BleakClient that behaves like the Pico.
+
+    Serves the same characteristics as the Pico firmware: writes to the pump
+    and manual-feed characteristics update the watered/fed timestamps (and
+    notify subscribers), the LED/pump state is kept.
+
+    `latency` is the simulated round-trip of one ATT operation, plus a
+    uniform random `jitter`. Each operation fails with BleakError with
+    probability `drop_rate`, and drops the whole link with probability
+    `disconnect_rate`. Only UUIDs in `notify_uuids` accept start_notify, the
+    rest raise like a real characteristic without the notify property.
+    With `frame` it also serves the packed SENSOR_FRAME_UUID characteristic.
+    """
+
+    # Shared across instances, so a multi-device run can see radio concurrency
+    inflight = 0
+    max_inflight = 0
+
+    def __init__(self, latency=0.03, notify_uuids=None, disconnected_callback=None,
+                 jitter=0.0, drop_rate=0.0, disconnect_rate=0.0, frame=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.disconnect_rate = disconnect_rate
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = True
+        self.services = None
+        self.frame = frame
+        if notify_uuids is None:
+            notify_uuids = list(bluetooth.SENSOR_CHARS) + [bluetooth.SENSOR_FRAME_UUID]
+        self.notify_uuids = set(notify_uuids)
+        self.reads = 0
+        self.writes = 0
+        self.dropped = 0
+        self.led = False
+        self.pump_in = False
+        self.pump_out = False
+        self._callbacks = {}
+        now = int(time.time() * 10_000_000)
+        self.values = {
+            bluetooth.TEMP_CHAR_UUID: struct.pack("<h", 2150),
+            bluetooth.HUMIDITY_CHAR_UUID: struct.pack("<h", 4520),
+            bluetooth.FEED_BIRDS_UUID: struct.pack("<q", now),
+            bluetooth.WATER_BIRDS_UUID: struct.pack("<q", now),
+        }
+
+    async def connect(self):
+        await asyncio.sleep(self.latency)
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    def drop(self):
+        """Simulate the Pico going out of range"""
+        self.is_connected = False
+        if self.disconnected_callback is not None:
+            self.disconnected_callback(self)
+
+    async def _round_trip(self):
+        if not self.is_connected:
+            raise BleakError("Not connected")
+        FakeBleakClient.inflight += 1
+        FakeBleakClient.max_inflight = max(FakeBleakClient.max_inflight, FakeBleakClient.inflight)
+        try:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        finally:
+            FakeBleakClient.inflight -= 1
+        if self.disconnect_rate and random.random() < self.disconnect_rate:
+            self.drop()
+            raise BleakError("Disconnected")
+        if self.drop_rate and random.random() < self.drop_rate:
+            self.dropped += 1
+            raise BleakError("ATT operation failed")
+
+    async def read_gatt_char(self, uuid):
+        await self._round_trip()
+        self.reads += 1
+        if uuid == bluetooth.SENSOR_FRAME_UUID:
+            if not self.frame:
+                raise BleakError(f"Characteristic {uuid} was not found!")
+            return bytearray(self._frame())
+        return bytearray(self.values[uuid])
+
+    def _frame(self):
+        return bluetooth.SENSOR_FRAME.pack(
+            struct.unpack("<h", self.values[bluetooth.TEMP_CHAR_UUID])[0],
+            struct.unpack("<h", self.values[bluetooth.HUMIDITY_CHAR_UUID])[0],
+            struct.unpack("<q", self.values[bluetooth.FEED_BIRDS_UUID])[0],
+            struct.unpack("<q", self.values[bluetooth.WATER_BIRDS_UUID])[0],
+        )
+
+    async def write_gatt_char(self, uuid, data, response=None):
+        await self._round_trip()
+        self.writes += 1
+        data = bytes(data)
+        stamp = struct.pack("<q", int(time.time() * 10_000_000))
+        if uuid == bluetooth.LED_CONTROL_UUID:
+            self.led = data == b"\x01"
+        elif uuid == bluetooth.PUMP_CONTROL_UUID:
+            if data in (b"\x00", b"\x01"):
+                self.pump_in = data == b"\x01"
+                if self.pump_in:
+                    self.set_value(bluetooth.WATER_BIRDS_UUID, stamp)
+            else:
+                self.pump_out = data == b"\x11"
+        elif uuid == bluetooth.MANUAL_FEED_BIRDS_UUID:
+            self.set_value(bluetooth.FEED_BIRDS_UUID, stamp)
+
+    async def start_notify(self, uuid, callback):
+        await self._round_trip()
+        if uuid not in self.notify_uuids:
+            raise BleakError("Characteristic does not support notify")
+        self._callbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self._callbacks.pop(uuid, None)
+
+    def set_value(self, uuid, data):
+        """Change a value on the 'peripheral' and notify subscribers"""
+        self.values[uuid] = bytes(data)
+        self._notify(uuid, data)
+        if self.frame:
+            self._notify(bluetooth.SENSOR_FRAME_UUID, self._frame())
+
+    def _notify(self, uuid, data):
+        callback = self._callbacks.get(uuid)
+        if callback is not None and self.is_connected:
+            # Notifications arrive one link latency after the change
+            asyncio.get_running_loop().call_later(
+                self.latency, lambda: asyncio.ensure_future(callback(uuid, bytearray(data)))
+            )
+
+
+async def _run_ingest(mode, duration, change_every, frame=False):
+    client = FakeBleakClient(frame=frame)
+    bluetooth.BLE_SENSOR_FRAME = frame
+    bluetooth.sensor_data = bluetooth.SensorData()
+    gatt = bluetooth.GATTScheduler(client, name="bench")
+    task = asyncio.create_task(bluetooth.BLE_task(gatt, mode=mode))
+    await asyncio.sleep(0.5)  # let the first cycle seed SensorData
+    client.reads = 0
+
+    latencies = []
+    start = time.perf_counter()
+    raw = 2150
+    while time.perf_counter() - start < duration:
+        await asyncio.sleep(random.uniform(0.5, 1.5) * change_every)
+        raw += 7
+        expected = raw / 100
+        changed = time.perf_counter()
+        client.set_value(bluetooth.TEMP_CHAR_UUID, struct.pack("<h", raw))
+        while bluetooth.sensor_data.temperature != expected:
+            await asyncio.sleep(0.005)
+        latencies.append(time.perf_counter() - changed)
+    elapsed = time.perf_counter() - start
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    latencies.sort()
+    return {
+        "reads_per_min": client.reads / elapsed * 60,
+        "lat_avg_ms": sum(latencies) / len(latencies) * 1000,
+        "lat_max_ms": latencies[-1] * 1000,
+        "changes": len(latencies),
+    }
+
+
+def bench_ingest(args):
+    print(f"{'mode':<12} {'reads/min':>10} {'avg ms':>9} {'max ms':>9} {'changes':>8}")
+    for mode, frame in (("poll", False), ("poll", True), ("notify", False), ("notify", True)):
+        r = asyncio.run(_run_ingest(mode, args.duration, args.change_every, frame))
+        label = mode + ("+frame" if frame else "")
+        print(f"{label:<12} {r['reads_per_min']:>10.1f} {r['lat_avg_ms']:>9.1f} "
+              f"{r['lat_max_ms']:>9.1f} {r['changes']:>8}")
+
+
+def _bench_app():
+    device = bluetooth.Device("pico", bluetooth.PICO_ADDRESS, sensor_data=bluetooth.sensor_data,
+                              store=bluetooth.state_store)
+    device.store.update(pump_out=True)
+    app = web.Application()
+    app['devices'] = {device.id: device}
+    app['default_device'] = device.id
+    return app
+
+
+async def _legacy_root(request):
+    """handle_root as it was before the page cache: format + encode every time"""
+    device = request.app['devices'][request.app['default_device']]
+    temp, humidity, fed_time, water_time = await device.sensor_data.get_values()
+    html = bluetooth.HTML_TEMPLATE % (
+        temp, humidity, bluetooth.format_time(fed_time), bluetooth.format_time(water_time),
+        "ON" if device.pump_in else "OFF",
+        "ON" if device.pump_out else "OFF",
+        "ON" if device.led_state else "OFF",
+        device.ble.state,
+    )
+    response = web.Response(text=html, content_type='text/html')
+    response.body  # force the encode like a real send would
+    return response
+
+
+def _bump_version():
+    """Same values, new version: every request after this misses the caches"""
+    store = bluetooth.state_store
+    store.state = store.state.replace(store.version + 1, {})
+
+
+async def _requests_per_sec(handler, request, seconds):
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for _ in range(100):
+            await handler(request)
+        count += 100
+    return count / (time.perf_counter() - start)
+
+
+async def _run_render(seconds):
+    app = _bench_app()
+    plain = make_mocked_request('GET', '/', app=app)
+    etag = (await bluetooth.handle_root(plain)).headers['ETag']
+    conditional = make_mocked_request('GET', '/', headers={'If-None-Match': etag}, app=app)
+
+    async def changing(request):
+        _bump_version()
+        return await bluetooth.handle_root(request)
+
+    return [
+        ("uncached (before)", await _requests_per_sec(_legacy_root, plain, seconds)),
+        ("cache miss", await _requests_per_sec(changing, plain, seconds)),
+        ("cache hit", await _requests_per_sec(bluetooth.handle_root, plain, seconds)),
+        ("304 not modified", await _requests_per_sec(bluetooth.handle_root, conditional, seconds)),
+    ]
+
+
+def bench_render(args):
+    print(f"{'handle_root':<20} {'req/s':>10}")
+    for name, rate in asyncio.run(_run_render(args.seconds)):
+        print(f"{name:<20} {rate:>10.0f}")
+
+
+async def _run_compress(seconds):
+    app = _bench_app()
+    results = []
+    for path, handler in (("/", bluetooth.handle_root), ("/status", bluetooth.handle_status)):
+        for encoding in ("identity", "gzip", "br"):
+            if encoding == "br" and bluetooth.brotli is None:
+                continue
+            request = make_mocked_request('GET', path, headers={'Accept-Encoding': encoding}, app=app)
+            size = len((await handler(request)).body)
+
+            async def changing(request, handler=handler):
+                _bump_version()
+                return await handler(request)
+
+            hit = await _requests_per_sec(handler, request, seconds)
+            miss = await _requests_per_sec(changing, request, seconds)
+            results.append((path, encoding, size, 1e6 / hit, 1e6 / miss))
+    return results
+
+
+def bench_compress(args):
+    print(f"{'path':<8} {'encoding':<9} {'bytes':>7} {'hit us/req':>11} {'miss us/req':>12}")
+    for path, encoding, size, hit_us, miss_us in asyncio.run(_run_compress(args.seconds)):
+        print(f"{path:<8} {encoding:<9} {size:>7} {hit_us:>11.1f} {miss_us:>12.1f}")
+    gzip_head = len(bluetooth.HTML_HEAD_GZIP.data)
+    print(f"static page head: {len(bluetooth.HTML_HEAD_BYTES)} bytes, {gzip_head} gzipped once at import")
+
+
+async def _run_devices(count, seconds, latency):
+    FakeBleakClient.inflight = FakeBleakClient.max_inflight = 0
+    clients = []
+
+    def factory(address, disconnected_callback=None):
+        client = FakeBleakClient(latency=latency, disconnected_callback=disconnected_callback)
+        clients.append(client)
+        return client
+
+    devices = [bluetooth.Device(f"sim{i}", f"00:00:00:00:00:{i:02X}") for i in range(count)]
+    radio = asyncio.Semaphore(bluetooth.RADIO_MAX_INFLIGHT)
+    connect_lock = asyncio.Lock()
+    stagger = bluetooth.POLL_INTERVAL / count
+    tasks = [
+        asyncio.create_task(bluetooth.run_device(d, radio, connect_lock, i * stagger, factory))
+        for i, d in enumerate(devices)
+    ]
+    await asyncio.sleep(seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    reads = sum(c.reads for c in clients)
+    samples = [len(d.sensor_data.history) for d in devices]
+    return {
+        "reads_per_s": reads / seconds,
+        "min_samples": min(samples),
+        "max_samples": max(samples),
+        "max_inflight": FakeBleakClient.max_inflight,
+    }
+
+
+def bench_devices(args):
+    bluetooth.POLL_INTERVAL = args.interval
+    bluetooth.POLL_ADAPTIVE = False  # every device polls at --interval
+    bluetooth.BLE_INGEST_MODE = "poll"
+    print(f"{'devices':>8} {'reads/s':>9} {'samples/dev':>12} {'max inflight':>13}")
+    for count in (int(n) for n in args.counts.split(",")):
+        r = asyncio.run(_run_devices(count, args.seconds, args.latency))
+        print(f"{count:>8} {r['reads_per_s']:>9.1f} {r['min_samples']:>5}-{r['max_samples']:<6} "
+              f"{r['max_inflight']:>13}")
+
+
+def bench_metrics(args):
+    hist = bluetooth.Histogram('bench_seconds', 'benchmark', ('device', 'op'))
+    counter = bluetooth.Counter('bench_total', 'benchmark', ('handler', 'status'))
+    values = [random.uniform(0, 0.2) for _ in range(1000)]
+    n = args.iterations
+
+    start = time.perf_counter()
+    for i in range(n):
+        hist.observe(values[i % 1000], "pico", "read_gatt_char")
+    observe_ns = (time.perf_counter() - start) / n * 1e9
+
+    start = time.perf_counter()
+    for i in range(n):
+        counter.inc("handle_status", 200)
+    inc_ns = (time.perf_counter() - start) / n * 1e9
+
+    start = time.perf_counter()
+    for i in range(n):
+        values[i % 1000]
+    loop_ns = (time.perf_counter() - start) / n * 1e9
+
+    print(f"Histogram.observe  {observe_ns - loop_ns:8.0f} ns/observation")
+    print(f"Counter.inc        {inc_ns - loop_ns:8.0f} ns/increment")
+
+
+def bench_decode(args):
+    n = args.samples
+    now = int(time.time() * 10_000_000)
+    temps = struct.pack(f"<{n}h", *(random.randint(-1000, 4000) for _ in range(n)))
+    ticks = struct.pack(f"<{n}q", *(now - i * 20_000_000 for i in range(n)))
+    humidity = temps
+
+    def timed(func):
+        start = time.perf_counter()
+        func()
+        return (time.perf_counter() - start) / n * 1e9
+
+    def per_sample():
+        history = bluetooth.SensorHistory(capacity=n)
+        for i in range(n):
+            temp = bluetooth._decode_temperature(temps[2 * i:2 * i + 2])
+            bluetooth._decode_time(ticks[8 * i:8 * i + 8])
+            history.append(now // 10_000_000, round(temp * 100), round(temp * 100))
+
+    def bulk():
+        history = bluetooth.SensorHistory(capacity=n)
+        history.extend(bluetooth._decode_ticks_bulk(ticks), bluetooth._decode_sint16_bulk(memoryview(temps)),
+                       bluetooth._decode_sint16_bulk(memoryview(humidity)))
+
+    print(f"{'decode ' + str(n) + ' samples':<28} {'ns/sample':>10}")
+    print(f"{'per-sample struct.unpack':<28} {timed(per_sample):>10.0f}")
+    numpy = bluetooth._numpy()
+    if numpy is not None:
+        print(f"{'bulk numpy':<28} {timed(bulk):>10.0f}")
+    bluetooth._numpy_module = None
+    print(f"{'bulk array':<28} {timed(bulk):>10.0f}")
+
+
+def bench_rules(args):
+    configs = [
+        {"field": "temperature", "op": ">", "value": 35, "action": "led_on"},
+        {"field": "humidity", "op": "<", "value": 30, "for": 600, "action": "water"},
+        {"field": "temperature", "op": ">=", "value": 30, "agg": "avg", "window": 600, "action": "led_off"},
+        {"field": "humidity", "op": "<", "value": 20, "agg": "min", "window": 600, "action": "pump_in_on"},
+    ]
+    rules = []
+    for i in range(args.rules):
+        config = dict(configs[i % len(configs)], id=f"r{i}", device="pico")
+        config["value"] = 1000  # never true, so only evaluation is measured
+        config["op"] = ">"
+        rules.append(bluetooth.Rule(config))
+    engine = bluetooth.RuleEngine(None, rules)
+    now = int(time.time())
+    samples = [(now + i * bluetooth.POLL_INTERVAL, random.randint(1500, 3000), random.randint(2000, 6000))
+               for i in range(args.samples)]
+
+    start = time.perf_counter()
+    for sample in samples:
+        engine.on_sample(*sample)
+    per_sample = (time.perf_counter() - start) / len(samples)
+
+    print(f"{'rule':<24} {'ns/sample':>10}")
+    for kind, config in zip(("threshold", "threshold + for", "avg over window", "min over window"), configs):
+        costs = [r.cpu_ns / r.evaluations for r in rules if r.config["action"] == config["action"]]
+        print(f"{kind:<24} {sum(costs) / len(costs):>10.0f}")
+    print(f"{len(rules)} rules: {per_sample * 1e6:.1f} us per sample, "
+          f"{per_sample / bluetooth.POLL_INTERVAL * 100:.4f}% of one core at POLL_INTERVAL={bluetooth.POLL_INTERVAL}s")
+
+
+PUMP_RUN = 600  # seconds the simulated pump runs
+
+
+def _sampling_trace(t, doors, pumps):
+    """(temperature, humidity, pump on) of a simulated aviary at t seconds after midnight.
+
+    Temperature follows a slow daily curve and drops 1.5°C when a door
+    opens; humidity climbs while the pump runs and then decays back.
+    """
+    temp = 18 + 3 * math.sin(2 * math.pi * (t / 86400 - 0.375)) + random.uniform(-0.02, 0.02)
+    humidity = 50 + random.uniform(-0.1, 0.1)
+    for start in doors:
+        if start <= t < start + 600:
+            temp -= 1.5 * (1 - (t - start) / 600)
+    pump = False
+    for start in pumps:
+        if start <= t < start + PUMP_RUN:
+            humidity += 0.05 * (t - start)
+            pump = True
+        elif t >= start + PUMP_RUN:
+            humidity += 0.05 * PUMP_RUN * math.exp(-(t - start - PUMP_RUN) / 3600)
+    return round(temp, 2), round(humidity, 2), pump
+
+
+def _simulate_sampling(sampler, seconds, doors, pumps):
+    """Run BLE_task's poll/sleep loop against the trace on a virtual clock; returns poll times"""
+    polls = []
+    t = 0.0
+    while t < seconds:
+        temp, humidity, pump = _sampling_trace(t, doors, pumps)
+        sampler.store.update(temperature=temp, humidity=humidity, pump_in=pump)
+        sampler.after_poll(("temperature", "humidity"), 2, now=t)
+        polls.append(t)
+        wake = t + sampler.interval
+        # AdaptiveSampler.sleep() ends early when a pump switches on
+        t = min([start for start in pumps if t < start < wake] + [wake])
+        if t < wake:
+            sampler.interval = sampler.min_interval
+    return polls
+
+
+def bench_sampling(args):
+    seconds = args.hours * 3600
+    random.seed(args.seed)
+    doors = sorted(random.uniform(0, seconds) for _ in range(args.doors))
+    pumps = [h * 3600 for h in (7, 19) if h * 3600 < seconds]
+    events = sorted(doors + pumps)
+
+    print(f"{args.hours}h simulated, {len(doors)} door openings, {len(pumps)} pump runs")
+    print(f"{'sampler':<22} {'polls':>7} {'reads':>7} {'saved':>7} {'changes':>8} "
+          f"{'event avg s':>12} {'event max s':>12}")
+    for label, max_interval in ((f"fixed {bluetooth.POLL_INTERVAL}s", bluetooth.POLL_INTERVAL),
+                                (f"adaptive <={args.max_interval}s", args.max_interval)):
+        random.seed(args.seed + 1)  # same sensor noise for both
+        sampler = bluetooth.AdaptiveSampler(bluetooth.StateStore(), "bench", max_interval=max_interval)
+        polls = _simulate_sampling(sampler, seconds, doors, pumps)
+        # Delay from each event to the first poll that could see it
+        delays = []
+        for event in events:
+            i = bisect_left(polls, event)
+            if i < len(polls):
+                delays.append(polls[i] - event)
+        stats = sampler.stats()
+        saved = stats['reads_saved'] / (stats['reads'] + stats['reads_saved']) * 100
+        print(f"{label:<22} {stats['polls']:>7} {stats['reads']:>7} {saved:>6.0f}% {stats['changes']:>8} "
+              f"{sum(delays) / len(delays):>12.2f} {max(delays):>12.2f}")
+
+
+async def _water_with_fault(fault, at, duration=0.3):
+    """Run water() on a device behind run_device, injecting a fault at its ON or OFF write.
+
+    Returns (water() outcome, seconds from water() returning until the
+    Pico's pump was off or None if it was still on after 10 s, and whether
+    the pump was on once the link was back and reapply() had run).
+    """
+    clients = []
+
+    def factory(address, disconnected_callback=None):
+        client = FakeBleakClient(latency=0.01, disconnected_callback=disconnected_callback)
+        if clients:  # same Pico, its outputs kept running while the link was down
+            client.led, client.pump_in, client.pump_out = clients[-1].led, clients[-1].pump_in, clients[-1].pump_out
+        clients.append(client)
+        return client
+
+    device = bluetooth.Device("pico", bluetooth.PICO_ADDRESS)
+    task = asyncio.create_task(bluetooth.run_device(device, client_factory=factory))
+    while not device.connected:
+        await asyncio.sleep(0.01)
+    water = asyncio.create_task(device.water(duration))
+    # ON: while the write is on the link (after the coalesce window); OFF: just before it is due
+    await asyncio.sleep(bluetooth.COALESCE_WINDOW + 0.005 if at == "ON" else duration - 0.05)
+    client = clients[-1]
+    if fault == "link drop":
+        client.drop()
+    elif fault == "write error":
+        client.drop_rate = 1.0  # every ATT operation fails for a while, link stays up
+        asyncio.get_running_loop().call_later(0.5, setattr, client, "drop_rate", 0.0)
+    try:
+        await water
+        outcome = "ok"
+    except Exception as e:
+        outcome = type(e).__name__
+    returned = time.perf_counter()
+    deadline = returned + 10
+    while clients[-1].pump_in and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    off_after = None if clients[-1].pump_in else time.perf_counter() - returned
+    if fault == "link drop":
+        while len(clients) < 2 or not device.connected:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.3)  # reconnected, give reapply() time to write
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await device.ble.disconnect()
+    return outcome, off_after, clients[-1].pump_in
+
+
+def bench_water_off(args):
+    """Exits 1 if any fault leaves the (fake) Pico pumping"""
+    bluetooth.WATER_OFF_RETRY_DELAY = 0.2
+    print(f"{'fault':<12} {'at':<4} {'water()':<16} {'pump off after s':>17} {'after reconnect':>16}")
+    failed = False
+    for fault, at in (("none", ""), ("write error", "ON"), ("link drop", "ON"),
+                      ("write error", "OFF"), ("link drop", "OFF")):
+        outcome, off_after, on_later = asyncio.run(_water_with_fault(fault, at))
+        failed = failed or off_after is None or on_later
+        print(f"{fault:<12} {at:<4} {outcome:<16} {'STILL ON' if off_after is None else f'{off_after:.2f}':>17} "
+              f"{'ON' if on_later else 'off':>16}")
+    sys.exit(1 if failed else 0)
+
+
+async def _record_capture(path, seconds, mode):
+    """Run BLE_task against a FakeBleakClient whose values keep changing, capturing its traffic"""
+    bluetooth.BLE_INGEST_MODE = mode
+    bluetooth.POLL_INTERVAL = 0.2
+    client = FakeBleakClient(latency=0.005)
+    gatt = bluetooth.GATTScheduler(client, name="record")
+    gatt.recorder = bluetooth.GattCapture(path)
+    task = asyncio.create_task(bluetooth.BLE_task(gatt, target=bluetooth.SensorData()))
+    deadline = time.perf_counter() + seconds
+    raw = 2000
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+        raw += random.randint(-5, 5)
+        client.set_value(bluetooth.TEMP_CHAR_UUID, struct.pack("<h", raw))
+        client.set_value(bluetooth.HUMIDITY_CHAR_UUID, struct.pack("<h", 4000 + raw // 10))
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    gatt.recorder.close()
+    return gatt.recorder.records_written
+
+
+async def _replay(path, mode):
+    """Replay a capture as fast as possible through BLE_task; returns (seconds, samples recorded)"""
+    bluetooth.BLE_INGEST_MODE = mode
+    bluetooth.POLL_INTERVAL = 0
+    target = bluetooth.SensorData()
+    client = bluetooth.ReplayBleakClient(path, speed=0)
+    await client.connect()
+    start = time.perf_counter()
+    task = asyncio.create_task(bluetooth.BLE_task(bluetooth.GATTScheduler(client, name="replay"), target=target))
+    if mode == "poll":
+        await task  # returns once the recorded reads run out and the link "drops"
+    else:
+        await client._player
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return elapsed, len(target.history)
+
+
+def bench_replay(args):
+    path = args.capture
+    if args.record:
+        if os.path.exists(path):
+            os.remove(path)
+        count = asyncio.run(_record_capture(path, args.record, args.mode))
+        print(f"recorded {count} GATT records ({os.path.getsize(path)} bytes) to {path}")
+
+    start = time.perf_counter()
+    count = sum(1 for _ in bluetooth.GattCapture.records(path))
+    scan = time.perf_counter() - start
+    print(f"mmap scan: {count} records in {scan * 1000:.1f} ms ({count / scan:,.0f} records/s)")
+
+    start = time.perf_counter()
+    decoded = 0
+    for _, kind, uuid, data in bluetooth.GattCapture.records(path):
+        if uuid in bluetooth.SENSOR_CHARS and kind != bluetooth.GattCapture.WRITE:
+            bluetooth.SENSOR_CHARS[uuid][1](data)
+            decoded += 1
+    decode = time.perf_counter() - start
+    print(f"scan + decode: {decoded} values in {decode * 1000:.1f} ms ({decoded / decode:,.0f} values/s)")
+
+    elapsed, samples = asyncio.run(_replay(path, args.mode))
+    print(f"replay through BLE_task ({args.mode}): {samples} samples in {elapsed * 1000:.0f} ms "
+          f"({samples / elapsed:,.0f} samples/s)")
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _import_times():
+    """(cumulative us, module) of the modules bluetooth.py imports directly"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bluetooth"],
+                            cwd=HERE, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2  # nested imports are indented by two per level
+        if depth == 1 or name.strip() == "bluetooth":
+            times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)
+
+
+def _time_to_first_response(port):
+    """Seconds from spawning main() until /status answers, and that first answer"""
+    script = (f"import asyncio, bluetooth; bluetooth.PORT = {port}; bluetooth.SENSOR_LOG_PATH = None; "
+              "asyncio.run(bluetooth.main())")
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "-c", script], cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/status", timeout=1) as r:
+                    return time.perf_counter() - start, json.load(r)
+            except OSError:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"bluetooth.main() exited with {proc.returncode}")
+                time.sleep(0.01)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def bench_startup(args):
+    times = _import_times()
+    total = dict((name, us) for us, name in times)["bluetooth"]
+    print(f"import bluetooth: {total / 1000:.1f} ms, slowest imports:")
+    for us, name in [t for t in times if t[1] != "bluetooth"][:args.top]:
+        print(f"  {us / 1000:>8.1f} ms  {name}")
+    runs = sorted(_time_to_first_response(args.port) for _ in range(args.runs))
+    ttfr, status = runs[len(runs) // 2]
+    print(f"time to first /status response: {ttfr * 1000:.0f} ms "
+          f"(median of {args.runs}, BLE state then: {status.get('ble_state')})")
+
+
+LOAD_MIX = [
+    # (label, path, weight)
+    ("/status", "/status", 40),
+    ("/", "/", 30),
+    ("actuators", "/led/on", 5),
+    ("actuators", "/led/off", 5),
+    ("actuators", "/pump_in/on", 4),
+    ("actuators", "/pump_in/off", 4),
+    ("actuators", "/pump_out/on", 4),
+    ("actuators", "/pump_out/off", 4),
+    ("actuators", "/feed", 4),
+]
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+async def _run_load(args):
+    clients = []
+
+    def factory(address, disconnected_callback=None):
+        client = FakeBleakClient(latency=args.latency, jitter=args.jitter, drop_rate=args.drop_rate,
+                                 disconnect_rate=args.disconnect_rate,
+                                 disconnected_callback=disconnected_callback)
+        clients.append(client)
+        return client
+
+    bluetooth.SENSOR_LOG_PATH = None
+    devices = bluetooth.load_devices(path="")
+    tasks = [
+        asyncio.create_task(bluetooth.web_server(devices, port=args.port)),
+        asyncio.create_task(bluetooth.run_device(next(iter(devices.values())), client_factory=factory)),
+    ]
+    await asyncio.sleep(1)  # server up, first BLE session established
+
+    labels = [label for label, _, _ in LOAD_MIX]
+    paths = [path for _, path, _ in LOAD_MIX]
+    weights = [weight for _, _, weight in LOAD_MIX]
+    latencies = {label: [] for label in labels}
+    errors = {label: 0 for label in labels}
+    base = f"http://127.0.0.1:{args.port}"
+    ops_before = sum(c.reads + c.writes for c in clients)
+
+    async def worker(session, deadline):
+        while time.perf_counter() < deadline:
+            i = random.choices(range(len(paths)), weights)[0]
+            start = time.perf_counter()
+            async with session.get(base + paths[i]) as response:
+                await response.read()
+            latencies[labels[i]].append(time.perf_counter() - start)
+            if response.status >= 400:
+                errors[labels[i]] += 1
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.clients)) as session:
+        await asyncio.gather(*(worker(session, start + args.duration) for _ in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    ble_ops = sum(c.reads + c.writes for c in clients) - ops_before
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return latencies, errors, ble_ops / elapsed, elapsed, devices
+
+
+def bench_load(args):
+    latencies, errors, ble_ops, elapsed, devices = asyncio.run(_run_load(args))
+    print(f"{args.clients} clients for {elapsed:.1f}s, BLE latency {args.latency * 1000:.0f}"
+          f"+{args.jitter * 1000:.0f} ms, drop rate {args.drop_rate}")
+    print(f"{'endpoint':<10} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for label, values in latencies.items():
+        values.sort()
+        print(f"{label:<10} {len(values):>9} {len(values) / elapsed:>8.1f} "
+              f"{_percentile(values, 0.5) * 1000:>8.1f} {_percentile(values, 0.99) * 1000:>8.1f} "
+              f"{errors[label]:>7}")
+    print(f"BLE ops/s: {ble_ops:.1f}")
+    device = next(iter(devices.values()))
+    print(f"GATT: {device.gatt.stats()}")
+    print(f"BLE link: {device.ble.metrics()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bluetooth.py benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("ingest", help="poll vs notify, per-value vs sensor frame: reads per minute and update latency")
+    p.add_argument("--duration", type=float, default=20.0)
+    p.add_argument("--change-every", type=float, default=3.0, help="mean seconds between value changes")
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("render", help="handle_root requests/second with and without the page cache")
+    p.add_argument("--seconds", type=float, default=2.0, help="time per variant")
+    p.set_defaults(func=bench_render)
+
+    p = sub.add_parser("compress", help="bytes on the wire and CPU per request for each content-encoding")
+    p.add_argument("--seconds", type=float, default=1.0)
+    p.set_defaults(func=bench_compress)
+
+    p = sub.add_parser("devices", help="polling N simulated Picos concurrently (poll mode)")
+    p.add_argument("--counts", default="1,2,4,8,16")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--interval", type=float, default=2.0, help="POLL_INTERVAL to use")
+    p.add_argument("--latency", type=float, default=0.03, help="fake ATT round-trip in seconds")
+    p.set_defaults(func=bench_devices)
+
+    p = sub.add_parser("metrics", help="per-observation cost of the /metrics instrumentation")
+    p.add_argument("--iterations", type=int, default=1_000_000)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("decode", help="per-sample vs bulk decoding of packed history samples")
+    p.add_argument("--samples", type=int, default=100_000)
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("rules", help="CPU cost of rule evaluation per sample")
+    p.add_argument("--rules", type=int, default=40)
+    p.add_argument("--samples", type=int, default=20_000)
+    p.set_defaults(func=bench_rules)
+
+    p = sub.add_parser("sampling", help="fixed vs adaptive poll interval over a simulated day")
+    p.add_argument("--hours", type=int, default=24)
+    p.add_argument("--doors", type=int, default=6, help="sudden temperature drops to detect")
+    p.add_argument("--max-interval", type=float, default=bluetooth.POLL_INTERVAL_MAX)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_sampling)
+
+    p = sub.add_parser("water-off", help="check water() leaves the pump off after a link drop or failed write")
+    p.set_defaults(func=bench_water_off)
+
+    p = sub.add_parser("startup", help="import time breakdown and time to first HTTP response")
+    p.add_argument("--top", type=int, default=10, help="how many imports to list")
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--port", type=int, default=8082)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("replay", help="record a GATT capture, then replay it through BLE_task as fast as possible")
+    p.add_argument("--capture", default="bench_capture.gattcap")
+    p.add_argument("--record", type=float, default=0, help="first record this many seconds of fake-Pico traffic")
+    p.add_argument("--mode", choices=("poll", "notify"), default="notify")
+    p.set_defaults(func=bench_replay)
+
+    p = sub.add_parser("load", help="concurrent HTTP clients against web_server while BLE_task runs")
+    p.add_argument("--clients", type=int, default=20)
+    p.add_argument("--duration", type=float, default=20.0)
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latency", type=float, default=0.03, help="fake ATT round-trip in seconds")
+    p.add_argument("--jitter", type=float, default=0.02, help="extra uniform random latency in seconds")
+    p.add_argument("--drop-rate", type=float, default=0.0, help="probability a GATT operation fails")
+    p.add_argument("--disconnect-rate", type=float, default=0.0, help="probability a GATT operation drops the link")
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
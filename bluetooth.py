@@ -1,18 +1,153 @@
 # Pi Zero Script (Python 3)
 import asyncio
+import gzip
+import heapq
+import math
+import mmap
+import operator
+import os
+import random
 import struct
-from bleak import BleakClient
+import sys
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import lru_cache
+from uuid import UUID
 import time
 import socket
-import http.server
-import socketserver
 from aiohttp import web
 import json
+import zlib
+
+try:
+    import brotli  # optional, adds Content-Encoding: br
+except ImportError:
+    brotli = None
 
 PORT = 8080
 pump_in = False
 pump_out = False
 
+# Sensor ingest: "notify" subscribes to GATT notifications and only polls the
+# characteristics the Pico doesn't notify on, "poll" reads everything every
+# POLL_INTERVAL seconds like before
+BLE_INGEST_MODE = "notify"
+POLL_INTERVAL = 2
+# Read all four sensor values from the packed SENSOR_FRAME_UUID characteristic
+# (one round-trip per poll instead of four). Needs Pico firmware that exposes
+# it; without it BLE_task falls back to the per-value characteristics
+BLE_SENSOR_FRAME = False
+# Adaptive polling: while polled readings stay within POLL_STABLE_DELTA of the
+# previous poll the interval grows by POLL_BACKOFF, up to POLL_INTERVAL_MAX.
+# A bigger change, or a pump switching on, drops it back to POLL_INTERVAL.
+# Set POLL_ADAPTIVE = False to poll every POLL_INTERVAL seconds regardless
+POLL_ADAPTIVE = True
+POLL_INTERVAL_MAX = 30
+POLL_BACKOFF = 2
+POLL_STABLE_DELTA = {'temperature': 0.1, 'humidity': 0.5}  # any change in the fed/watered times counts
+
+# GATT scheduler: lower number runs first, timeouts are per operation (seconds)
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 10
+GATT_READ_TIMEOUT = 5
+GATT_WRITE_TIMEOUT = 5
+
+# Actuator writes requested within this many seconds collapse into one
+COALESCE_WINDOW = 0.05
+
+# Device.water(): attempts at the pump OFF write while the link is up, this
+# many seconds apart. With the link down the OFF stays requested and
+# ActuatorReconciler.reapply() writes it on reconnect
+WATER_OFF_ATTEMPTS = 3
+WATER_OFF_RETRY_DELAY = 1
+
+# Seconds between keepalive comments on idle /events streams
+EVENTS_KEEPALIVE = 15
+
+# Temperature/humidity history: one week of samples at POLL_INTERVAL (~2.4 MB)
+HISTORY_CAPACITY = 7 * 24 * 3600 // POLL_INTERVAL
+HISTORY_MAX_POINTS = 1000  # /history widens step rather than return more
+
+# SQLite sensor log (set SENSOR_LOG_PATH = None to disable). Samples are
+# committed in batches; raw rows older than SENSOR_LOG_RAW_DAYS are rolled up
+# into hourly min/max/avg
+SENSOR_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sensor_log.db")
+SENSOR_LOG_BATCH = 60
+SENSOR_LOG_FLUSH_INTERVAL = 120
+SENSOR_LOG_RAW_DAYS = 7
+SENSOR_LOG_ROLLUP_INTERVAL = 3600
+# Unwritten rows kept for retry while writes fail; the oldest are dropped first
+SENSOR_LOG_MAX_PENDING = 50 * SENSOR_LOG_BATCH
+
+# Multiple Picos: devices.json next to this script lists them as
+#   [{"id": "aviary1", "address": "2C:CF:67:C9:C3:66", "name": "Front aviary"}, ...]
+# Without it the single PICO_ADDRESS below is used. Connections are made one
+# at a time, DEVICE_STAGGER seconds apart, and at most RADIO_MAX_INFLIGHT GATT
+# operations run at once across all devices
+DEVICES_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "devices.json")
+DEVICE_STAGGER = 0.5
+RADIO_MAX_INFLIGHT = 2
+
+# Static files served under /static/ (only these names). Images get resized
+# JPEG/WebP variants for the widths below, built once with Pillow (if it is
+# installed) and kept in STATIC_CACHE_DIR
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_CACHE_DIR = os.path.join(STATIC_DIR, ".static_cache")
+STATIC_FILES = ("bird1.jpg",)
+IMAGE_WIDTHS = (200, 400)  # the page shows bird1.jpg at 200x200, 400 for 2x screens
+STATIC_MAX_AGE = 365 * 86400
+# Full-size original sent for a ?w= request (variants not built yet, or no
+# Pillow): cached briefly so the browser asks again for the small one
+STATIC_FALLBACK_MAX_AGE = 60
+
+# Response compression: bodies under COMPRESS_MIN_SIZE bytes go out as-is
+COMPRESS_MIN_SIZE = 512
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Recurring feed/water jobs (cron syntax, local time), kept in SCHEDULE_PATH.
+# A "water" job runs pump in for its duration (seconds). The scheduler sleeps
+# until the next job is due, but at most SCHEDULE_MAX_SLEEP so a clock step
+# (the Pi has no RTC, NTP corrects it after boot) is picked up
+SCHEDULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schedule.json")
+SCHEDULE_WATER_DURATION = 10
+SCHEDULE_MAX_WATER_DURATION = 600
+SCHEDULE_MAX_SLEEP = 300
+
+# Sensor-triggered automation rules (see RuleEngine), read at startup. A rule
+# fires once when its condition becomes true, then not again until it has
+# been false and RULE_COOLDOWN seconds have passed
+RULES_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
+RULE_COOLDOWN = 300
+RULE_WATER_DURATION = 60
+
+# Time zone the dashboard shows fed/watered times in (IANA name, DST-aware);
+# None uses the Pi's local time zone. The API can also return raw epoch or
+# ISO 8601 times (?time=epoch|iso) for clients that format them themselves
+DISPLAY_TIMEZONE = "America/New_York"
+
+# GATT capture: with BLE_CAPTURE_PATH set, every read/write/notification of
+# each device is appended to that file (see GattCapture). With
+# BLE_REPLAY_PATH set, the devices talk to a ReplayBleakClient playing that
+# capture back (at BLE_REPLAY_SPEED x real time, 0 = as fast as possible)
+# instead of a Pico
+BLE_CAPTURE_PATH = None
+BLE_REPLAY_PATH = None
+BLE_REPLAY_SPEED = 1.0
+
+# POST /commands: most steps per batch, longest a batch may take (delays
+# plus water durations, seconds) and duration of a water step without one
+COMMANDS_MAX_STEPS = 32
+COMMANDS_MAX_DURATION = 900
+COMMANDS_WATER_DURATION = 60
+
+# Reconnect backoff (seconds): doubles per failed attempt up to the max, jittered
+BLE_BACKOFF_BASE = 1
+BLE_BACKOFF_MAX = 60
+
 
 
 # PICO'S ADDRESS AND UUIDs (MUST MATCH PICO'S CODE)
@@ -25,6 +160,12 @@ LED_CONTROL_UUID = "932c32bd-0004-47a2-835a-a8d455b859dd"  # Custom LED UUID (MU
 WATER_BIRDS_UUID = "932c32bd-0005-47a2-835a-a8d455b859dd"
 FEED_BIRDS_UUID = "932c32bd-0006-47a2-835a-a8d455b859dd"
 MANUAL_FEED_BIRDS_UUID = "932c32bd-0007-47a2-835a-a8d455b859dd"
+SENSOR_FRAME_UUID = "932c32bd-0008-47a2-835a-a8d455b859dd"  # Packed temp/humidity/fed/watered (optional)
+
+# Sensor frame layout: temperature and humidity as sint16 hundredths, fed and
+# watered time as int64 ticks, same encodings as the single characteristics.
+# 20 bytes, fits a default 23-byte ATT MTU read
+SENSOR_FRAME = struct.Struct("<hhqq")
 
 def get_ip():
     """Get actual IP address of the Raspberry Pi"""
@@ -43,55 +184,702 @@ def _decode_temperature(data):
     return struct.unpack("<h", data)[0] / 100
 
 def _decode_time(data):
-    """Decode time from 8-byte format (seconds since epoch * 10^7)."""
+    """Decode time from 8-byte format (seconds since epoch * 10^7) to epoch seconds."""
     try:
         if len(data) != 8:  # Ensure 8 bytes are received
             print(f"Invalid data length: {len(data)} bytes (expected 8)")
             return None
         time_in_ticks = struct.unpack("<q", data)[0]  # Unpack 8-byte integer
-        time_in_seconds = time_in_ticks / 10_000_000  # Convert back to seconds
-        converted_time = time.strftime(
-            "%a, %d %b %Y %H:%M:%S", time.gmtime(time_in_seconds - 14400)
-        )
-        return converted_time
+        return time_in_ticks / 10_000_000  # Convert back to seconds
     except Exception as e:
         print(f"Error decoding time: {e}")
         return None
 
-class SensorData:
+@lru_cache(maxsize=None)
+def _zone(name):
+    """ZoneInfo for an IANA name; None (local time) if it's None or unknown here"""
+    if name is None:
+        return None
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo(name)
+    except Exception as e:  # no zoneinfo/tzdata, or a bad name
+        print(f"Time zone {name} not available, using local time: {e}")
+        return None
+
+def _to_datetime(epoch, tz_name):
+    zone = _zone(tz_name)
+    if zone is None:
+        return datetime.fromtimestamp(epoch).astimezone()
+    return datetime.fromtimestamp(epoch, zone)
+
+@lru_cache(maxsize=64)
+def _format_time(epoch, tz_name):
+    """Display form of an epoch timestamp. Cached: fed/watered times rarely change
+    but are shown on every page render."""
+    if epoch is None:
+        return "Never"
+    return _to_datetime(epoch, tz_name).strftime("%a, %d %b %Y %H:%M:%S")
+
+def format_time(epoch):
+    return _format_time(epoch, DISPLAY_TIMEZONE)
+
+# Keys of the state dicts (/status, /events) that hold epoch timestamps
+TIME_KEYS = ('last_fed', 'last_watered')
+
+def _present_times(state, time_format="text"):
+    """Copy of a state dict with its timestamps as display text, ISO 8601 or epoch"""
+    state = dict(state)
+    for key in TIME_KEYS:
+        if key not in state:
+            continue
+        epoch = state[key]
+        if time_format == "text":
+            state[key] = format_time(epoch)
+        elif time_format == "iso":
+            state[key] = None if epoch is None else _to_datetime(epoch, DISPLAY_TIMEZONE).isoformat(timespec='seconds')
+    return state
+
+_numpy_module = False  # not looked up yet
+
+def _numpy():
+    """numpy if it's installed, imported on first use (it's slow to load on a Pi Zero)"""
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy as _numpy_module
+        except ImportError:
+            _numpy_module = None
+    return _numpy_module
+
+# Bulk decoders for blocks of packed samples, for a history backfill from the
+# Pico. Library-only for now: the firmware has no such characteristic yet, so
+# only benchmark.py decode calls them
+
+def _decode_sint16_bulk(data):
+    """Decode many packed sint16 samples at once (bytes or memoryview).
+
+    Returns the raw hundredths as an int16 numpy array (a view of `data`, no
+    copy) or, without numpy, an array('h'). No per-sample Python objects.
+    """
+    np = _numpy()
+    if np is not None:
+        return np.frombuffer(data, dtype='<i2')
+    values = array('h')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def _decode_ticks_bulk(data):
+    """Decode many packed 8-byte Pico timestamps into epoch seconds.
+
+    Returns a uint32 numpy array or, without numpy, an array('I'), the same
+    representation SensorHistory keeps. Formatting for display is left to
+    format_time() on the few values actually shown. The array fallback still
+    divides sample by sample (no Python list, but a loop); only numpy is
+    vectorised. Both raise ValueError for a time before 1970 or past 2106
+    rather than wrap it.
+    """
+    np = _numpy()
+    if np is not None:
+        seconds = np.frombuffer(data, dtype='<i8') // 10_000_000
+        if len(seconds) and (seconds.min() < 0 or seconds.max() > 0xFFFFFFFF):
+            raise ValueError("Timestamp out of range")
+        return seconds.astype(np.uint32)
+    ticks = array('q')
+    ticks.frombytes(data)
+    if sys.byteorder == 'big':
+        ticks.byteswap()
+    if ticks and (min(ticks) < 0 or max(ticks) // 10_000_000 > 0xFFFFFFFF):
+        raise ValueError("Timestamp out of range")
+    return array('I', (t // 10_000_000 for t in ticks))
+
+def _as_array(values, typecode):
+    """array(typecode) from an array, numpy array or any sequence of ints"""
+    if isinstance(values, array) and values.typecode == typecode:
+        return values
+    result = array(typecode)
+    np = _numpy() if not isinstance(values, (array, list, tuple)) else None
+    if np is not None and isinstance(values, np.ndarray):
+        result.frombytes(values.astype(typecode, copy=False).tobytes())
+    else:
+        result.extend(values)
+    return result
+
+# Latency histogram bucket bounds in seconds (Prometheus "le" labels)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _label_text(names, values, extra=""):
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Prometheus-style histogram; observe() is a dict lookup, a bisect and three adds"""
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> per-bucket counts + [sum, count]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bounds = [str(b) for b in self.buckets] + ["+Inf"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {value}")
+        return lines
+
+def render_gauge(name, help, labelnames, samples, kind="gauge"):
+    """Lines for (label values, value) pairs computed at scrape time"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_label_text(labelnames, labels)} {value}")
+    return lines
+
+GATT_LATENCY = Histogram('gatt_operation_seconds', 'GATT operation latency on the link', ('device', 'op'))
+GATT_QUEUE_WAIT = Histogram('gatt_queue_wait_seconds', 'Time GATT operations wait in the scheduler queue', ('device',))
+GATT_ERRORS = Counter('gatt_operation_errors_total', 'Failed GATT operations', ('device', 'op', 'reason'))
+HTTP_LATENCY = Histogram('http_request_seconds', 'HTTP handler latency', ('handler',))
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by handler and status', ('handler', 'status'))
+SCHEDULE_LATENCY = Histogram('schedule_job_seconds', 'Scheduled job execution time', ('device', 'action'))
+SCHEDULE_RUNS = Counter('schedule_job_runs_total', 'Scheduled job runs by outcome', ('device', 'action', 'outcome'))
+POLL_DETECT_LATENCY = Histogram('poll_change_detect_seconds',
+                                'Upper bound on how late a poll saw a reading change', ('device',),
+                                buckets=(1, 2, 4, 8, 16, 30, 60))
+METRICS = [GATT_LATENCY, GATT_QUEUE_WAIT, GATT_ERRORS, HTTP_LATENCY, HTTP_REQUESTS,
+           SCHEDULE_LATENCY, SCHEDULE_RUNS, POLL_DETECT_LATENCY]
+
+class StateSubscriber:
+    """Pending changes for one push client; newer values overwrite unsent ones"""
+
     def __init__(self):
-        self.temperature = 14.5
-        self.humidity = 12.4
-        self._lock = asyncio.Lock()
-        
-    async def update(self, temp, humidity, fed_time, water_time):
-        async with self._lock:
-            self.temperature = temp
-            self.humidity = humidity
-            self.fed_time = fed_time
-            self.water_time = water_time
+        self.pending = {}
+        self._event = asyncio.Event()
+
+    def push(self, changes):
+        self.pending.update(changes)
+        self._event.set()
+
+    async def next(self, timeout=None):
+        """Wait for changes and return them (empty dict on timeout)"""
+        # A timer instead of wait_for: wait_for can swallow a cancel that
+        # arrives together with a change, leaving the waiter running
+        timer = None
+        if timeout is not None:
+            timer = asyncio.get_running_loop().call_later(timeout, self._event.set)
+        try:
+            await self._event.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        self._event.clear()
+        changes, self.pending = self.pending, {}
+        return changes
+
+class DeviceState:
+    """Immutable snapshot of everything known about one Pico.
+
+    Field names are the keys /status and /events use. Times are epoch
+    seconds (None = never); version goes up by one with every change.
+    """
+
+    __slots__ = ('version', 'temperature', 'humidity', 'last_fed', 'last_watered',
+                 'pump_in', 'pump_out', 'led_state', 'ble_state')
+    FIELDS = __slots__[1:]
+
+    def __init__(self, version: int = 0, temperature: float = 14.5, humidity: float = 12.4,
+                 last_fed: float = None, last_watered: float = None, pump_in: bool = False,
+                 pump_out: bool = False, led_state: bool = False, ble_state: str = "disconnected"):
+        self.version = version
+        self.temperature = temperature
+        self.humidity = humidity
+        self.last_fed = last_fed
+        self.last_watered = last_watered
+        self.pump_in = pump_in
+        self.pump_out = pump_out
+        self.led_state = led_state
+        self.ble_state = ble_state
+
+    def replace(self, version, changes):
+        values = self.as_dict()
+        values.update(changes)
+        return DeviceState(version, **values)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+class StateStore:
+    """The one place a device's state lives.
+
+    update() swaps in a new DeviceState with a single assignment, so readers
+    take `state` without a lock and always get a consistent set, and pushes
+    the changed fields to subscribers (the /events clients). The version
+    keys the page and /status caches, so they rebuild only after a change.
+    """
+
+    def __init__(self, state=None):
+        self.state = state or DeviceState()
+        self._subscribers = set()
+
+    @property
+    def version(self):
+        return self.state.version
+
+    def subscribe(self):
+        sub = StateSubscriber()
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers.discard(sub)
+
+    def update(self, **values):
+        """Apply the values that differ from the current state; returns those"""
+        state = self.state
+        changes = {field: value for field, value in values.items() if getattr(state, field) != value}
+        if changes:
+            self.state = state.replace(state.version + 1, changes)
+            for sub in self._subscribers:
+                sub.push(changes)
+        return changes
+
+state_store = StateStore()
+
+class SensorHistory:
+    """Fixed-size ring buffer of (epoch seconds, temp, humidity) samples.
+
+    Values are kept as raw sint16 hundredths like the Pico sends them, in
+    preallocated arrays, so memory never grows after startup.
+    """
+
+    def __init__(self, capacity=HISTORY_CAPACITY):
+        self.capacity = capacity
+        self.times = array('I', bytes(4 * capacity))
+        self.temps = array('h', bytes(2 * capacity))
+        self.humidity = array('h', bytes(2 * capacity))
+        self.start = 0  # physical index of the oldest sample
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, temp_raw, humidity_raw):
+        if self.count < self.capacity:
+            i = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            i = self.start  # overwrite the oldest
+            self.start = (self.start + 1) % self.capacity
+        self.times[i] = timestamp
+        self.temps[i] = temp_raw
+        self.humidity[i] = humidity_raw
+
+    def extend(self, times, temps, humidity):
+        """Append many samples at once (oldest first), e.g. a backfill.
+
+        Accepts arrays, numpy arrays or sequences and copies them in with at
+        most two slice assignments per column instead of one append per sample.
+        """
+        n = len(times)
+        if n > self.capacity:
+            times, temps, humidity = times[-self.capacity:], temps[-self.capacity:], humidity[-self.capacity:]
+            n = self.capacity
+        end = (self.start + self.count) % self.capacity  # next physical write position
+        first = min(n, self.capacity - end)
+        for column, values, typecode in ((self.times, times, 'I'), (self.temps, temps, 'h'),
+                                         (self.humidity, humidity, 'h')):
+            values = _as_array(values, typecode)
+            column[end:end + first] = values[:first]
+            column[:n - first] = values[first:]
+        overflow = max(0, self.count + n - self.capacity)
+        self.count = min(self.capacity, self.count + n)
+        self.start = (self.start + overflow) % self.capacity
+
+    def _bisect(self, timestamp):
+        """Logical index of the first sample at or after timestamp"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[(self.start + mid) % self.capacity] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _sum(self, values, lo, hi):
+        """Sum of logical range [lo, hi) without copying it into a list"""
+        a = (self.start + lo) % self.capacity
+        b = a + (hi - lo)
+        if b <= self.capacity:
+            return sum(values[a:b])
+        return sum(values[a:]) + sum(values[:b - self.capacity])
+
+    def query(self, t_from, t_to, step):
+        """Average samples into step-second buckets over [t_from, t_to).
+
+        Returns (step, points) with points as (bucket start, temp, humidity);
+        empty buckets are skipped and step is widened to stay under
+        HISTORY_MAX_POINTS.
+        """
+        step = max(step, -(-(t_to - t_from) // HISTORY_MAX_POINTS), 1)
+        points = []
+        lo = self._bisect(t_from)
+        for bucket in range(t_from, t_to, step):
+            hi = self._bisect(min(bucket + step, t_to))
+            n = hi - lo
+            if n:
+                points.append((
+                    bucket,
+                    round(self._sum(self.temps, lo, hi) / n / 100, 2),
+                    round(self._sum(self.humidity, lo, hi) / n / 100, 2),
+                ))
+            lo = hi
+        return step, points
+
+class SensorLog:
+    """Batched SQLite (WAL) persistence of the samples SensorData records.
+
+    All SQLite work runs on one executor thread so SD-card fsyncs never block
+    the event loop; the connection lives on that thread.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS samples (
+            ts INTEGER NOT NULL, temp INTEGER NOT NULL, humidity INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+        CREATE TABLE IF NOT EXISTS hourly (
+            hour INTEGER PRIMARY KEY, samples INTEGER NOT NULL,
+            temp_min INTEGER, temp_max INTEGER, temp_avg REAL,
+            humidity_min INTEGER, humidity_max INTEGER, humidity_avg REAL);
+    """
+
+    def __init__(self, path, batch_size=SENSOR_LOG_BATCH, flush_interval=SENSOR_LOG_FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sensor-log")
+        self._db = None
+        self._pending = []
+        self._flushing = None
+        self.written = 0
+        self.commits = 0
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        import sqlite3  # only needed once the log thread opens the database
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # WAL keeps this crash-safe
+        self._db.executescript(self.SCHEMA)
+
+    def _write(self, rows):
+        with self._db:
+            self._db.executemany("INSERT INTO samples VALUES (?, ?, ?)", rows)
+
+    def _rollup(self, cutoff):
+        with self._db:
+            self._db.execute("""
+                INSERT OR REPLACE INTO hourly
+                SELECT ts / 3600 * 3600, COUNT(*),
+                       MIN(temp), MAX(temp), AVG(temp),
+                       MIN(humidity), MAX(humidity), AVG(humidity)
+                FROM samples WHERE ts < ? GROUP BY ts / 3600""", (cutoff,))
+            self._db.execute("DELETE FROM samples WHERE ts < ?", (cutoff,))
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _recent(self, since):
+        return self._db.execute(
+            "SELECT ts, temp, humidity FROM samples WHERE ts >= ? ORDER BY ts", (since,)).fetchall()
+
+    async def open(self):
+        await self._call(self._open)
+
+    async def restore(self, history):
+        """Refill the in-memory history from the raw samples still on disk"""
+        since = int(time.time()) - history.capacity * POLL_INTERVAL
+        rows = await self._call(self._recent, since)
+        if rows:
+            history.extend(*zip(*rows))
+
+    def add(self, timestamp, temp_raw, humidity_raw):
+        self._pending.append((timestamp, temp_raw, humidity_raw))
+        if len(self._pending) >= self.batch_size and self._flushing is None:
+            self._flushing = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # Errors are handled here: add() starts flushes as unawaited tasks
+        rows, self._pending = self._pending, []
+        try:
+            if rows:
+                await self._call(self._write, rows)
+                self.written += len(rows)
+                self.commits += 1
+        except Exception as e:
+            # Put the batch back ahead of anything added meanwhile, for the next flush
+            self._pending = (rows + self._pending)[-SENSOR_LOG_MAX_PENDING:]
+            print(f"Sensor log error: {e} ({len(self._pending)} sample(s) pending)")
+        finally:
+            self._flushing = None
+
+    async def rollup(self):
+        # Whole hours only, so an hour is never split between the two tables
+        cutoff = (int(time.time()) - SENSOR_LOG_RAW_DAYS * 86400) // 3600 * 3600
+        await self._call(self._rollup, cutoff)
+
+    async def run(self):
+        """Flush on a timer (for slow sample rates) and roll up old data"""
+        last_rollup = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - last_rollup >= SENSOR_LOG_ROLLUP_INTERVAL:
+                    await self.rollup()
+                    last_rollup = time.monotonic()
+            except Exception as e:
+                print(f"Sensor log error: {e}")
+
+    async def close(self):
+        await self.flush()
+        if self._db is not None:
+            await self._call(self._db.close)
+        self._executor.shutdown()
+
+class SensorData:
+    """Readings from the Pico, kept in the device's StateStore.
+
+    Also feeds each temperature/humidity sample to the history, the
+    on-disk log and the rule engine.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or state_store
+        self.history = SensorHistory()
+        self.log = None  # SensorLog, when persistence is enabled
+        self.rules = None  # RuleEngine, when automation rules are configured
+
+    @property
+    def temperature(self):
+        return self.store.state.temperature
+
+    @property
+    def humidity(self):
+        return self.store.state.humidity
+
+    @property
+    def last_fed(self):
+        return self.store.state.last_fed
+
+    @property
+    def last_watered(self):
+        return self.store.state.last_watered
+
+    def _record(self, state):
+        sample = (int(time.time()), round(state.temperature * 100), round(state.humidity * 100))
+        self.history.append(*sample)
+        if self.log is not None:
+            self.log.add(*sample)
+        if self.rules is not None:
+            self.rules.on_sample(*sample)
+
+    async def update(self, temp, humidity, last_fed, last_watered):
+        self.store.update(temperature=temp, humidity=humidity,
+                          last_fed=last_fed, last_watered=last_watered)
+        self._record(self.store.state)
+
+    async def set_value(self, field, value):
+        """Update a single reading (used by notification callbacks)"""
+        if self.store.update(**{field: value}) and field in ('temperature', 'humidity'):
+            self._record(self.store.state)
             
     async def get_values(self):
-        async with self._lock:
-            return (self.temperature, self.humidity, self.fed_time, self.water_time)
+        state = self.store.state
+        return (state.temperature, state.humidity, state.last_fed, state.last_watered)
 
 sensor_data = SensorData()
 
+def _bleak_client_class():
+    from bleak import BleakClient
+    return BleakClient
+
+async def _import_bleak_client():
+    """BleakClient, imported in a thread: bleak (dbus-fast etc.) takes seconds
+    to load on a Pi Zero and the web server is already answering by then"""
+    return await asyncio.get_running_loop().run_in_executor(None, _bleak_client_class)
+
 class BLEController:
-    def __init__(self):
+    """Connection manager for one Pico.
+
+    Connects, watches for the link dropping and reconnects with jittered
+    exponential backoff: disconnected -> connecting -> connected, and
+    connecting -> backoff -> connecting while the Pico doesn't answer.
+    """
+
+    DISCONNECTED = "disconnected"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    BACKOFF = "backoff"
+
+    def __init__(self, address=PICO_ADDRESS, client_factory=None, connect_lock=None):
+        self.address = address
+        self.client_factory = client_factory  # None: BleakClient, imported on first connect
+        self.connect_lock = connect_lock
         self.client = None
-        self.connected = False
+        self.state = self.DISCONNECTED
+        self._disconnect_callbacks = []
+        self._state_callbacks = []
+        self._lost = asyncio.Event()
+        self.attempt = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.failures = 0
+        self.started = time.monotonic()
+        self.down_since = self.started
+        self.connected_since = None
+        self.total_uptime = 0.0
+        self.last_reconnect_time = None
+
+    @property
+    def connected(self):
+        return self.state == self.CONNECTED
+
+    def add_disconnect_callback(self, callback):
+        """callback(controller) runs whenever an established link goes away"""
+        self._disconnect_callbacks.append(callback)
+
+    def add_state_callback(self, callback):
+        """callback(controller) runs on every state change"""
+        self._state_callbacks.append(callback)
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"BLE {self.address}: {self.state} -> {state}")
+            self.state = state
+            for callback in self._state_callbacks:
+                callback(self)
+
+    def _backoff_delay(self):
+        delay = min(BLE_BACKOFF_MAX, BLE_BACKOFF_BASE * 2 ** self.attempt)
+        # Jitter so several Picos (or a rebooted one) don't retry in lockstep
+        return delay / 2 + random.uniform(0, delay / 2)
         
     async def connect(self):
-        self.client = BleakClient(PICO_ADDRESS)
-        await self.client.connect()
-        self.connected = True
+        self._set_state(self.CONNECTING)
+        self._lost.clear()
+        if self.client_factory is None:
+            self.client_factory = await _import_bleak_client()
+        client = self.client_factory(self.address, disconnected_callback=self._handle_disconnect)
+        try:
+            if self.connect_lock is None:
+                await client.connect()
+            else:
+                async with self.connect_lock:  # BlueZ copes badly with parallel connects
+                    await client.connect()
+        except Exception:
+            self.failures += 1
+            self._set_state(self.DISCONNECTED)
+            raise
+        now = time.monotonic()
+        self.client = client
+        self.last_reconnect_time = now - self.down_since
+        self.connected_since = now
+        self.connects += 1
+        self.attempt = 0
+        self._set_state(self.CONNECTED)
         print("Connected to BLE device")
+
+    def _handle_disconnect(self, client):
+        """bleak's disconnected_callback, also used when we drop the link ourselves"""
+        if client is not self.client or self.state != self.CONNECTED:
+            return
+        now = time.monotonic()
+        self.total_uptime += now - self.connected_since
+        self.connected_since = None
+        self.down_since = now
+        self.disconnects += 1
+        self._set_state(self.DISCONNECTED)
+        self._lost.set()
+        for callback in self._disconnect_callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                print(f"Disconnect callback failed: {e}")
         
     async def disconnect(self):
-        if self.connected:
-            await self.client.disconnect()
-            self.connected = False
+        client = self.client
+        if client is not None:
+            self._handle_disconnect(client)
+            self.client = None
+            try:
+                await client.disconnect()
+            except Exception as e:
+                print(f"BLE disconnect error: {e}")
+
+    async def run(self, session):
+        """Keep the link up forever, running session(client) while connected"""
+        while True:
+            try:
+                await self.connect()
+            except Exception as e:
+                delay = self._backoff_delay()
+                self.attempt += 1
+                print(f"BLE connect to {self.address} failed: {e}, retrying in {delay:.1f}s")
+                self._set_state(self.BACKOFF)
+                await asyncio.sleep(delay)
+                continue
+
+            task = asyncio.create_task(session(self.client))
+            lost = asyncio.create_task(self._lost.wait())
+            try:
+                await asyncio.wait({task, lost}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                task.cancel()
+                lost.cancel()
+            if task.done() and not task.cancelled() and task.exception() is not None:
+                print(f"BLE session error: {task.exception()}")
+            # Link lost or session gave up on it: drop the client and start over
+            await self.disconnect()
+            self._set_state(self.BACKOFF)
+            await asyncio.sleep(self._backoff_delay())
             
     async def control_led(self, state: bool):
         if not self.connected:
@@ -101,15 +889,442 @@ class BLEController:
         await self.client.write_gatt_char(LED_CONTROL_UUID, value)
         print(f"LED set to {'ON' if state else 'OFF'}")
 
-# Shared BLE controller instance
-ble_controller = BLEController()
+    def metrics(self):
+        now = time.monotonic()
+        session = now - self.connected_since if self.connected_since is not None else 0.0
+        return {
+            'state': self.state,
+            'connects': self.connects,
+            'disconnects': self.disconnects,
+            'connect_failures': self.failures,
+            'last_reconnect_s': None if self.last_reconnect_time is None else round(self.last_reconnect_time, 2),
+            'uptime_s': round(session, 1),
+            'total_uptime_s': round(self.total_uptime + session, 1),
+            'availability': round((self.total_uptime + session) / max(now - self.started, 1e-9), 4),
+        }
+
+class GATTScheduler:
+    """Owns the BleakClient and runs one GATT operation at a time.
+
+    Everything (BLE_task, HTTP handlers) goes through here instead of calling
+    the client directly, so operations never interleave on the link.
+    Writes default to user priority and jump ahead of queued background reads.
+    Exposes the same read/write/notify methods as BleakClient.
+    `radio` is an optional semaphore shared by the schedulers of all devices.
+    """
+
+    def __init__(self, client, radio=None, name=""):
+        self.client = client
+        self.radio = radio
+        self.name = name  # device label for metrics
+        self._queue = asyncio.PriorityQueue()
+        self._seq = 0
+        self._worker = None
+        self.ops = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recorder = None  # GattCapture, when capturing
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    @property
+    def services(self):
+        return self.client.services
+
+    async def _submit(self, priority, timeout, func, *args):
+        if not self.is_connected:
+            raise ConnectionError("BLE not connected")
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1  # keeps FIFO order within a priority
+        await self._queue.put((priority, self._seq, time.monotonic(), timeout, func, args, future))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return await future
+
+    async def _run(self):
+        while True:
+            priority, _, queued_at, timeout, func, args, future = await self._queue.get()
+            if future.cancelled():
+                continue
+            wait = time.monotonic() - queued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.ops += 1
+            GATT_QUEUE_WAIT.observe(wait, self.name)
+            op = func.__name__
+            start = time.perf_counter()
+            try:
+                result = await self._execute(timeout, func, args)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                GATT_ERRORS.inc(self.name, op, "timeout")
+                if not future.done():
+                    future.set_exception(TimeoutError(f"GATT operation timed out after {timeout}s"))
+            except Exception as e:
+                self.errors += 1
+                GATT_ERRORS.inc(self.name, op, type(e).__name__)
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                GATT_LATENCY.observe(time.perf_counter() - start, self.name, op)
+                if self.recorder is not None:
+                    self._capture(self.recorder.record_op, op, args, result)
+                if not future.done():
+                    future.set_result(result)
+
+    async def _execute(self, timeout, func, args):
+        if self.radio is None:
+            return await asyncio.wait_for(func(*args), timeout)
+        async with self.radio:
+            return await asyncio.wait_for(func(*args), timeout)
+
+    async def read_gatt_char(self, uuid, priority=PRIORITY_BACKGROUND, timeout=GATT_READ_TIMEOUT):
+        return await self._submit(priority, timeout, self.client.read_gatt_char, uuid)
+
+    async def read_gatt_chars(self, uuids, priority=PRIORITY_BACKGROUND, timeout=GATT_READ_TIMEOUT):
+        """Read several characteristics as one scheduled burst.
+
+        The reads run back to back in a single queue slot (and radio slot),
+        so nothing interleaves and the queue wait is paid once. `timeout`
+        applies per read.
+        """
+        uuids = list(uuids)
+        return await self._submit(priority, timeout * len(uuids), self._read_burst, uuids)
+
+    async def _read_burst(self, uuids):
+        return [await self.client.read_gatt_char(uuid) for uuid in uuids]
+
+    async def write_gatt_char(self, uuid, data, priority=PRIORITY_USER, timeout=GATT_WRITE_TIMEOUT, response=None):
+        return await self._submit(priority, timeout, self.client.write_gatt_char, uuid, data, response)
+
+    async def start_notify(self, uuid, callback):
+        async def notified(sender, data):
+            if self.recorder is not None:
+                self._capture(self.recorder.record, GattCapture.NOTIFY, uuid, data)
+            await callback(sender, data)
+        return await self._submit(PRIORITY_BACKGROUND, GATT_READ_TIMEOUT, self.client.start_notify, uuid, notified)
+
+    def _capture(self, record, *args):
+        """Hand traffic to the recorder; if capturing fails it stops, the link carries on"""
+        try:
+            record(*args)
+        except Exception as e:
+            print(f"GATT capture failed, recording stopped: {e}")
+            recorder, self.recorder = self.recorder, None
+            try:
+                recorder.close()
+            except Exception:
+                pass
+
+    def fail_pending(self, exc):
+        """Fail everything still queued, e.g. when the link drops"""
+        while not self._queue.empty():
+            future = self._queue.get_nowait()[-1]
+            if not future.done():
+                future.set_exception(exc)
+
+    def stats(self):
+        return {
+            'queue_depth': self._queue.qsize(),
+            'max_queue_depth': self.max_depth,
+            'ops': self.ops,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'avg_wait_ms': round(self.total_wait / self.ops * 1000, 2) if self.ops else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 2),
+        }
+
+class GattCapture:
+    """Append-only binary log of GATT traffic, for replaying it later.
+
+    Each record is RECORD (data length, wall-clock time, kind, 16-byte
+    UUID) followed by the data, after an 8-byte MAGIC file header.
+    records() reads a capture back through mmap without loading it.
+
+    The file is unbuffered: each record goes to the OS in one write, so
+    stopping the service (SIGTERM) or a crash keeps everything up to the
+    last operation, which is the part an incident needs.
+    """
+
+    MAGIC = b"GATTCAP1"
+    RECORD = struct.Struct("<HdB16s")
+    READ, WRITE, NOTIFY = 1, 2, 3
+
+    def __init__(self, path):
+        self.path = path
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "ab", buffering=0)
+        if new:
+            self._file.write(self.MAGIC)
+        self.records_written = 0
+
+    def record(self, kind, uuid, data):
+        data = bytes(data)
+        self._file.write(self.RECORD.pack(len(data), time.time(), kind, UUID(uuid).bytes) + data)
+        self.records_written += 1
+
+    def record_op(self, op, args, result):
+        """Record a completed GATTScheduler operation"""
+        if op == 'read_gatt_char':
+            self.record(self.READ, args[0], result)
+        elif op == '_read_burst':
+            for uuid, data in zip(args[0], result):
+                self.record(self.READ, uuid, data)
+        elif op == 'write_gatt_char':
+            self.record(self.WRITE, args[0], args[1])
+
+    def close(self):
+        self._file.close()
+
+    @classmethod
+    def map(cls, path):
+        """mmap of a capture file, None if it holds no records yet"""
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= len(cls.MAGIC):
+                return None
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[:len(cls.MAGIC)] != cls.MAGIC:
+            mm.close()
+            raise ValueError(f"{path} is not a GATT capture")
+        return mm
+
+    @classmethod
+    def scan(cls, mm):
+        """Yield (offset, timestamp, kind) for each complete record in a mapped capture"""
+        offset = len(cls.MAGIC)
+        end = len(mm) - cls.RECORD.size
+        while offset <= end:
+            length, timestamp, kind, _ = cls.RECORD.unpack_from(mm, offset)
+            if offset + cls.RECORD.size + length > len(mm):
+                break  # torn last record, the capture was cut off mid-write
+            yield offset, timestamp, kind
+            offset += cls.RECORD.size + length
+
+    @classmethod
+    def read(cls, mm, offset):
+        """(timestamp, kind, uuid, data) of the record at offset"""
+        length, timestamp, kind, raw_uuid = cls.RECORD.unpack_from(mm, offset)
+        start = offset + cls.RECORD.size
+        return timestamp, kind, str(UUID(bytes=raw_uuid)), mm[start:start + length]
+
+    @classmethod
+    def records(cls, path):
+        """Yield (timestamp, kind, uuid, data) for every record in a capture"""
+        mm = cls.map(path)
+        if mm is None:
+            return
+        with mm:
+            for offset, _, _ in cls.scan(mm):
+                yield cls.read(mm, offset)
+
+class CaptureIndex:
+    """Record offsets of a mapped GattCapture, built in one pass over the headers.
+
+    Data stays in the mapping until a replay asks for it. main() builds one
+    per capture and every ReplayBleakClient (one per reconnect) shares it,
+    so starting the capture over doesn't read the file again.
+    """
+
+    def __init__(self, path):
+        self.mm = GattCapture.map(path)
+        self.first = None
+        self.reads = {}  # uuid -> array of record offsets, in order
+        self.notifications = array('Q')
+        if self.mm is None:
+            return
+        for offset, timestamp, kind in GattCapture.scan(self.mm):
+            if self.first is None:
+                self.first = timestamp
+            if kind == GattCapture.READ:
+                uuid = str(UUID(bytes=GattCapture.RECORD.unpack_from(self.mm, offset)[3]))
+                self.reads.setdefault(uuid, array('Q')).append(offset)
+            elif kind == GattCapture.NOTIFY:
+                self.notifications.append(offset)
+
+    def record(self, offset):
+        """(timestamp, uuid, data) of the record at offset"""
+        timestamp, _, uuid, data = GattCapture.read(self.mm, offset)
+        return timestamp, uuid, data
+
+class ReplayBleakClient:
+    """Stands in for BleakClient and plays back a GattCapture, no Pico needed.
+
+    Reads return the recorded values of that characteristic in order and
+    notifications are delivered at their recorded times, scaled by `speed`
+    (0 = as fast as possible). Writes are accepted and kept in `writes`.
+    When the reads run out the link "drops", like a Pico going away, and
+    BLEController's reconnect starts the capture over.
+
+    `capture` is a CaptureIndex, or a path to build one from.
+    """
+
+    def __init__(self, capture, speed=1.0, disconnected_callback=None):
+        if not isinstance(capture, CaptureIndex):
+            capture = CaptureIndex(capture)
+        self.capture = capture
+        self.speed = speed
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self.services = None
+        self.first = capture.first
+        self._next_read = {}  # uuid -> position in capture.reads[uuid]
+        self.writes = []
+        self._callbacks = {}
+        self._player = None
+        self._started = None
+
+    async def _until(self, timestamp):
+        """Sleep until a recorded time comes round in replay time"""
+        if self.speed:
+            delay = (timestamp - self.first) / self.speed - (time.monotonic() - self._started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def connect(self):
+        self.is_connected = True
+        self._started = time.monotonic()
+        self._player = asyncio.create_task(self._play_notifications())
+
+    async def disconnect(self):
+        if self._player is not None:
+            self._player.cancel()
+        self.is_connected = False
+
+    def _drop(self):
+        if self.is_connected:
+            self.is_connected = False
+            if self.disconnected_callback is not None:
+                self.disconnected_callback(self)
+
+    async def _play_notifications(self):
+        for offset in self.capture.notifications:
+            timestamp, uuid, data = self.capture.record(offset)
+            await self._until(timestamp)
+            callback = self._callbacks.get(uuid)
+            if callback is not None:
+                await callback(uuid, bytearray(data))
+            elif not self.speed:
+                await asyncio.sleep(0)
+
+    async def read_gatt_char(self, uuid):
+        offsets = self.capture.reads.get(uuid, ())
+        position = self._next_read.get(uuid, 0)
+        if position >= len(offsets):
+            self._drop()
+            raise ConnectionError("End of capture")
+        self._next_read[uuid] = position + 1
+        timestamp, _, data = self.capture.record(offsets[position])
+        await self._until(timestamp)
+        return bytearray(data)
+
+    async def write_gatt_char(self, uuid, data, response=None):
+        self.writes.append((uuid, bytes(data)))
+
+    async def start_notify(self, uuid, callback):
+        self._callbacks[uuid] = callback
+
+    async def stop_notify(self, uuid):
+        self._callbacks.pop(uuid, None)
+
+class ActuatorReconciler:
+    """Keeps desired vs acknowledged state per actuator and only writes the difference.
+
+    Requests that arrive while a write is pending join it, so a burst of
+    toggles ends in a single write of the final state. A request matching the
+    acknowledged state is dropped without touching the link.
+
+    on_ack(name, state) runs after every acknowledged write, so whatever
+    shows the state only ever shows what the Pico confirmed. When a write
+    fails, `desired` goes back to the last acknowledged state, so reapply()
+    never switches something on that the Pico didn't confirm. A failed OFF
+    is the exception: it stays requested and reapply() writes it on the next
+    connection, because switching off is always safe.
+    """
+
+    # name -> (uuid, off value, on value)
+    ACTUATORS = {
+        'led': (LED_CONTROL_UUID, b"\x00", b"\x01"),
+        'pump_in': (PUMP_CONTROL_UUID, b"\x00", b"\x01"),
+        'pump_out': (PUMP_CONTROL_UUID, b"\x10", b"\x11"),
+    }
+
+    def __init__(self, gatt, window=COALESCE_WINDOW, on_ack=None):
+        self.gatt = gatt
+        self.window = window
+        self.on_ack = on_ack
+        self.desired = {}
+        self.actual = {}  # None/missing = unknown, always write
+        self.acked = {}  # last acknowledged state, kept across link drops
+        self._pending = {}
+        self.writes = 0
+        self.dropped = 0
+
+    async def set(self, name, state):
+        """Request a state; returns True once a write is acknowledged, False if it was redundant"""
+        self.desired[name] = state
+        future = self._pending.get(name)
+        if future is None:
+            if self.actual.get(name) == state:
+                self.dropped += 1
+                return False
+            future = asyncio.get_running_loop().create_future()
+            self._pending[name] = future
+            asyncio.create_task(self._reconcile(name, future))
+        else:
+            self.dropped += 1
+        return await asyncio.shield(future)
+
+    async def _reconcile(self, name, future):
+        uuid, off, on = self.ACTUATORS[name]
+        wrote = False
+        try:
+            await asyncio.sleep(self.window)
+            while self.actual.get(name) != self.desired[name]:
+                target = self.desired[name]
+                await self.gatt.write_gatt_char(uuid, on if target else off, response=True)
+                self.actual[name] = self.acked[name] = target
+                self.writes += 1
+                wrote = True
+                if self.on_ack is not None:
+                    self.on_ack(name, target)
+        except Exception as e:
+            self.actual.pop(name, None)  # unknown now, next request retries
+            if self.desired.get(name):
+                if name in self.acked:
+                    self.desired[name] = self.acked[name]
+                else:
+                    del self.desired[name]
+            self._pending.pop(name, None)
+            future.set_exception(e)
+            return
+        self._pending.pop(name, None)
+        future.set_result(wrote)
+
+    async def reapply(self):
+        """Write every requested state again, e.g. after a reconnect.
+
+        The link dropped with `actual` cleared, so the last acknowledged
+        states, and any OFF that failed while the link was down, get their
+        write now.
+        """
+        for name, state in list(self.desired.items()):
+            try:
+                await self.set(name, state)
+            except Exception as e:
+                print(f"Re-applying {name}={'ON' if state else 'OFF'} failed: {e}")
 
 # Update HTML template to add LED control
-HTML_TEMPLATE = """<!DOCTYPE html>
+# Static head (CSS/JS) never changes, only the body is formatted per state
+HTML_HEAD = """<!DOCTYPE html>
 <html>
 <head>
     <title>Home Control webpage</title>
-    <meta http-equiv="refresh" content="5">
     <style>
         body { 
             font-family: Arial, sans-serif; 
@@ -169,51 +1384,72 @@ HTML_TEMPLATE = """<!DOCTYPE html>
     </style>
     <script>
         function feedBirds() {
-            fetch('/feed')
+            fetch('feed')
                 .then(response => {
                     if (!response.ok) throw new Error('Feeding failed');
-                    updateTimestamps();
                 })
                 .catch(error => console.error('Error:', error));
         }
 
         function controlPump(pump, action) {
-            fetch(`/${pump}/${action}`)
-                .then(updateButtonStates);
+            fetch(`${pump}/${action}`);
         }
 
         function controlLED(state) {
-            fetch(`/led/${state}`)
-                .then(updateButtonStates);
+            fetch(`led/${state}`);
+        }
+
+        function applyState(data) {
+            const onOff = value => value ? 'ON' : 'OFF';
+            const oneDecimal = value => value.toFixed(1);
+            const asText = value => value;
+            const fields = {
+                temperature: ['temperature', oneDecimal],
+                humidity: ['humidity', oneDecimal],
+                last_fed: ['last-fed', asText],
+                last_watered: ['last-watered', asText],
+                pump_in: ['pump-in-state', onOff],
+                pump_out: ['pump-out-state', onOff],
+                led_state: ['led-state', onOff],
+                ble_state: ['ble-state', asText],
+            };
+            for (const [key, [id, format]] of Object.entries(fields)) {
+                if (data[key] !== undefined && data[key] !== null) {
+                    document.getElementById(id).textContent = format(data[key]);
+                }
+            }
         }
 
-         function updateButtonStates() {
-            fetch('/status')
+        function updateButtonStates() {
+            fetch('status')
                 .then(response => response.json())
-                .then(data => {
-                    document.getElementById('pump-in-state').textContent = data.pump_in ? 'ON' : 'OFF';
-                    document.getElementById('pump-out-state').textContent = data.pump_out ? 'ON' : 'OFF';
-                    document.getElementById('led-state').textContent = data.led_state ? 'ON' : 'OFF';
-                    document.getElementById('last-fed').textContent = data.last_fed;
-                    document.getElementById('last-watered').textContent = data.last_watered;
-                });
+                .then(applyState);
         }
 
-        // Initial update and set interval
-        document.addEventListener('DOMContentLoaded', updateButtonStates);
-        setInterval(updateButtonStates, 1000);
+        // Relative URLs so /devices/<id>/ pages talk to their own Pico.
+        // Server pushes a full state on connect and then only changes;
+        // EventSource reconnects by itself if the Pi restarts
+        if (window.EventSource) {
+            const events = new EventSource('events');
+            events.onmessage = event => applyState(JSON.parse(event.data));
+        } else {
+            document.addEventListener('DOMContentLoaded', updateButtonStates);
+            setInterval(updateButtonStates, 5000);
+        }
     </script>
 </head>
-<body>
+"""
+
+HTML_BODY_TEMPLATE = """<body>
     <h1>Home Control webpage</h1>
-    <img src="/static/bird1.jpg" alt="Bird" />
+    <img src="/static/bird1.jpg?w=200" srcset="/static/bird1.jpg?w=400 2x" alt="Bird" />
     <div class="sensor-data">
-        <h2>Temperature: %.1f&#176;C</h2>
-        <h2>Humidity: %.1f%%</h2>
+        <h2>Temperature: <span id="temperature">%.1f</span>&#176;C</h2>
+        <h2>Humidity: <span id="humidity">%.1f</span>%%</h2>
     </div>
     <div class="timestamps">
-        <h2>Last Fed: %s</h2>
-        <h2>Last Watered: %s</h2>
+        <h2>Last Fed: <span id="last-fed">%s</span></h2>
+        <h2>Last Watered: <span id="last-watered">%s</span></h2>
     </div>
     <div class="controls">
         <button class="feed-button" onclick="feedBirds()">FEED BIRDS NOW</button>
@@ -227,6 +1463,7 @@ HTML_TEMPLATE = """<!DOCTYPE html>
     <div class="status">
         <p>Pump In Status: <span id="pump-in-state">%s</span></p>
         <p>Pump Out Status: <span id="pump-out-state">%s</span></p>
+        <p>Pico: <span id="ble-state">%s</span></p>
     </div>
 
     <div class="led-control">
@@ -238,37 +1475,944 @@ HTML_TEMPLATE = """<!DOCTYPE html>
 </body>
 </html>"""
 
+class StaticAssets:
+    """Serves STATIC_FILES, plus pre-resized JPEG/WebP variants of the images.
+
+    Variants are generated once (in an executor, Pillow is slow on a Pi Zero)
+    and cached on disk under a name that includes the source's mtime/size, so
+    later starts just reuse them. Until they exist the original is served.
+    """
+
+    def __init__(self, directory=STATIC_DIR, cache_dir=STATIC_CACHE_DIR, files=STATIC_FILES):
+        self.directory = directory
+        self.cache_dir = cache_dir
+        self.files = files
+        self.variants = {}  # (name, width, "jpeg"/"webp") -> path
+
+    def version(self, name):
+        """Changes whenever the source file does; used in URLs and cache file names"""
+        try:
+            st = os.stat(os.path.join(self.directory, name))
+        except OSError:
+            return "0"
+        return f"{int(st.st_mtime):x}{st.st_size:x}"
+
+    def _build(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            print("Pillow not installed, serving images at full size")
+            return {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        variants = {}
+        for name in self.files:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in (".jpg", ".jpeg", ".png"):
+                continue
+            version = self.version(name)
+            image = None
+            for width in IMAGE_WIDTHS:
+                for fmt, suffix in (("jpeg", ".jpg"), ("webp", ".webp")):
+                    path = os.path.join(self.cache_dir, f"{stem}-{version}-{width}{suffix}")
+                    if not os.path.exists(path):
+                        if image is None:
+                            image = Image.open(os.path.join(self.directory, name)).convert("RGB")
+                        # Same square the page stretches it to
+                        resized = image.resize((width, width), Image.LANCZOS)
+                        resized.save(path + ".tmp", fmt.upper(), quality=80)
+                        os.replace(path + ".tmp", path)
+                    variants[(name, width, fmt)] = path
+        return variants
+
+    async def build(self):
+        try:
+            self.variants = await asyncio.get_running_loop().run_in_executor(None, self._build)
+        except Exception as e:
+            print(f"Building image variants failed: {e}")
+
+    def resolve(self, name, width, accept):
+        """Best file for the request: (path, content type)"""
+        if width is not None:
+            if "image/webp" in accept and (name, width, "webp") in self.variants:
+                return self.variants[(name, width, "webp")], "image/webp"
+            if (name, width, "jpeg") in self.variants:
+                return self.variants[(name, width, "jpeg")], "image/jpeg"
+        return os.path.join(self.directory, name), None
+
+static_assets = StaticAssets()
+
+# Version the image URLs so browsers can cache them for good
+HTML_BODY_TEMPLATE = HTML_BODY_TEMPLATE.replace(
+    "/static/bird1.jpg?", f"/static/bird1.jpg?v={static_assets.version('bird1.jpg')}&")
+
+HTML_TEMPLATE = HTML_HEAD + HTML_BODY_TEMPLATE
+HTML_HEAD_BYTES = HTML_HEAD.encode()
+
+class GzipPrefix:
+    """Gzip stream for a fixed prefix, compressed once.
+
+    finish(tail) continues from a copy of the compressor state, so each
+    response only pays for compressing its own tail and the result is one
+    valid gzip stream of prefix + tail.
+    """
+
+    def __init__(self, prefix, level=GZIP_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 = gzip wrapper
+        self.data = self._compressor.compress(prefix) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, tail):
+        compressor = self._compressor.copy()
+        return self.data + compressor.compress(tail) + compressor.flush()
 
-async def web_server(ble_client):
+HTML_HEAD_GZIP = GzipPrefix(HTML_HEAD_BYTES)
+
+# Distinguishes ETags across restarts, the state version starts over at 0
+BOOT_ID = format(int(time.time()), 'x')
+
+def _accepted_encoding(request):
+    """Best content-encoding we can produce that the client accepts (None = identity)"""
+    accepted = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        if 'q=' in params:
+            try:
+                q = float(params.split('q=', 1)[1])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+class PageCache:
+    """Last rendered response, reused until the state version moves on.
+
+    The body is `head + tail`; only the tail is rendered per version.
+    Compressed encodings are built at most once per version, and with a
+    head_gzip the gzip variant only compresses the tail.
+    """
+
+    def __init__(self, head=b"", head_gzip=None):
+        self.head = head
+        self.head_gzip = head_gzip
+        self.version = None
+        self.body = None
+        self.etag = None
+        self.renders = 0
+        self._tail = None
+        self._encoded = {}
+
+    def get(self, version):
+        if version == self.version:
+            return self.body, self.etag
+        return None
+
+    def put(self, version, tail):
+        self.version = version
+        self._tail = tail
+        self.body = self.head + tail
+        self.etag = f'"{BOOT_ID}-{version}"'
+        self._encoded = {}
+        self.renders += 1
+        return self.body, self.etag
+
+    def encoded(self, encoding):
+        """(body, etag) in the given content-encoding"""
+        if encoding is None:
+            return self.body, self.etag
+        if encoding not in self._encoded:
+            if encoding == 'gzip' and self.head_gzip is not None:
+                data = self.head_gzip.finish(self._tail)
+            elif encoding == 'gzip':
+                data = gzip.compress(self.body, GZIP_LEVEL)
+            else:
+                data = brotli.compress(self.body, quality=BROTLI_QUALITY)
+            self._encoded[encoding] = (data, f'{self.etag[:-1]}-{encoding}"')
+        return self._encoded[encoding]
+
+def _cached_response(request, cache, content_type, cache_control='no-cache'):
+    """Serve the current entry of a PageCache, compressed if the client allows"""
+    encoding = _accepted_encoding(request) if len(cache.body) >= COMPRESS_MIN_SIZE else None
+    body, etag = cache.encoded(encoding)
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return web.Response(body=body, content_type=content_type, charset='utf-8', headers=headers)
+
+class Device:
+    """One Pico: its BLE link, sensor readings and actuator state"""
+
+    def __init__(self, device_id, address, name=None, sensor_data=None, store=None):
+        self.id = device_id
+        self.address = address
+        self.name = name or device_id
+        self.store = store or StateStore()
+        self.sensor_data = sensor_data or SensorData(self.store)
+        self.page_cache = PageCache(HTML_HEAD_BYTES, HTML_HEAD_GZIP)
+        self.status_cache = PageCache()
+        self.ble = BLEController(address)
+        self.ble.add_disconnect_callback(self._on_disconnect)
+        self.ble.add_state_callback(lambda ble: self.store.update(ble_state=ble.state))
+        self.gatt = GATTScheduler(None, name=device_id)
+        self.actuators = ActuatorReconciler(self.gatt, on_ack=self._on_actuator_ack)
+        self.command_lock = asyncio.Lock()  # one /commands batch at a time
+        self.command_runs = set()
+        self.sampler = AdaptiveSampler(self.store, device_id)
+
+    def attach(self, client, radio=None):
+        """Route GATT traffic through a connected client"""
+        self.gatt.client = client
+        self.gatt.radio = radio
+
+    def _on_disconnect(self, controller):
+        self.gatt.fail_pending(ConnectionError("BLE link lost"))
+        self.actuators.actual.clear()  # the Pico may have reset, reapply() rewrites on reconnect
+
+    # ActuatorReconciler name -> DeviceState field
+    ACTUATOR_FIELDS = {'led': 'led_state', 'pump_in': 'pump_in', 'pump_out': 'pump_out'}
+
+    def _on_actuator_ack(self, name, state):
+        self.store.update(**{self.ACTUATOR_FIELDS[name]: state})
+
+    @property
+    def connected(self):
+        return self.gatt.is_connected
+
+    @property
+    def pump_in(self):
+        return self.store.state.pump_in
+
+    @property
+    def pump_out(self):
+        return self.store.state.pump_out
+
+    @property
+    def led_state(self):
+        return self.store.state.led_state
+
+    @property
+    def last_fed(self):
+        return self.store.state.last_fed
+
+    @property
+    def last_watered(self):
+        return self.store.state.last_watered
+
+    async def _stamp(self, field, before):
+        """Optimistic fed/watered time after an acknowledged write.
+
+        The Pico stamps the action itself; its value replaces ours with the
+        next poll or notification. Skipped if that already came in.
+        """
+        if getattr(self.store.state, field) == before:
+            await self.sensor_data.set_value(field, time.time())
+
+    async def feed(self):
+        """Trigger the feeder: one acknowledged write, no read back"""
+        before = self.last_fed
+        await self.gatt.write_gatt_char(MANUAL_FEED_BIRDS_UUID, b"\x01", response=True)
+        await self._stamp('last_fed', before)
+
+    # The store follows acknowledged writes only (see _on_actuator_ack)
+    async def set_pump_in(self, on):
+        before = self.last_watered
+        if await self.actuators.set('pump_in', on) and on:
+            await self._stamp('last_watered', before)
+
+    async def set_led(self, on):
+        await self.actuators.set('led', on)
+
+    async def set_pump_out(self, on):
+        await self.actuators.set('pump_out', on)
+
+    async def water(self, duration):
+        """Run pump in for duration seconds"""
+        if not self.connected:
+            raise ConnectionError("BLE not connected")
+        try:
+            # Inside the try: an ON lost to a link drop may still have reached the Pico
+            await self.set_pump_in(True)
+            await asyncio.sleep(duration)
+        finally:
+            await self._pump_in_off()
+
+    async def _pump_in_off(self):
+        """Switch pump in off, retrying failed writes while the link is up.
+
+        If the link is down the OFF stays the desired state, so it is written
+        as soon as run_device reconnects; the error still reaches the caller.
+        """
+        for attempt in range(1, WATER_OFF_ATTEMPTS + 1):
+            try:
+                await self.set_pump_in(False)
+                return
+            except Exception as e:
+                if not self.connected or attempt == WATER_OFF_ATTEMPTS:
+                    print(f"Pump in OFF failed ({e}), rewritten on reconnect")
+                    raise
+                await asyncio.sleep(WATER_OFF_RETRY_DELAY)
+
+    async def run_commands(self, steps, report):
+        """Run checked /commands steps in order, stopping at the first failure.
+
+        report(result) gets one dict per step and a final {"done": ...}.
+        Batches for the same device queue up behind each other, so their
+        steps never interleave on the link.
+        """
+        async with self.command_lock:
+            for i, step in enumerate(steps):
+                start = time.perf_counter()
+                try:
+                    if 'delay' in step:
+                        await asyncio.sleep(step['delay'])
+                    else:
+                        await DEVICE_ACTIONS[step['action']](self, step.get('duration', COMMANDS_WATER_DURATION))
+                    error = None
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                result = dict(step, step=i, ok=error is None, ms=round((time.perf_counter() - start) * 1000, 1))
+                if error is not None:
+                    result['error'] = error
+                report(result)
+                if error is not None:
+                    report({'done': True, 'ok': False, 'completed': i})
+                    return
+            report({'done': True, 'ok': True, 'completed': len(steps)})
+
+# Actions rules and /commands can run: name -> action(device, duration)
+DEVICE_ACTIONS = {
+    'feed': lambda device, duration: device.feed(),
+    'water': lambda device, duration: device.water(duration),
+    'led_on': lambda device, duration: device.set_led(True),
+    'led_off': lambda device, duration: device.set_led(False),
+    'pump_in_on': lambda device, duration: device.set_pump_in(True),
+    'pump_in_off': lambda device, duration: device.set_pump_in(False),
+    'pump_out_on': lambda device, duration: device.set_pump_out(True),
+    'pump_out_off': lambda device, duration: device.set_pump_out(False),
+}
+
+def parse_commands(body):
+    """Check a /commands batch up front; returns the steps or raises ValueError.
+
+    A step is {"action": <DEVICE_ACTIONS name>} ("water" may add
+    "duration") or {"delay": seconds}.
+    """
+    if not isinstance(body, list) or not body:
+        raise ValueError("Body must be a non-empty JSON list of steps")
+    if len(body) > COMMANDS_MAX_STEPS:
+        raise ValueError(f"At most {COMMANDS_MAX_STEPS} steps per batch")
+    total = 0
+    for i, step in enumerate(body):
+        if not isinstance(step, dict):
+            raise ValueError(f"Step {i}: must be a JSON object")
+        if set(step) == {'delay'}:
+            seconds = step['delay']
+        elif 'action' in step and set(step) <= {'action', 'duration'}:
+            if step['action'] not in DEVICE_ACTIONS:
+                raise ValueError(f"Step {i}: action must be one of {', '.join(DEVICE_ACTIONS)}")
+            if 'duration' in step and step['action'] != 'water':
+                raise ValueError(f"Step {i}: only water takes a duration")
+            seconds = step.get('duration', COMMANDS_WATER_DURATION) if step['action'] == 'water' else 0
+        else:
+            raise ValueError(f"Step {i}: needs either action (and duration) or delay")
+        if (not isinstance(seconds, (int, float)) or isinstance(seconds, bool)
+                or not math.isfinite(seconds) or seconds < 0):
+            raise ValueError(f"Step {i}: delay/duration must be a number of seconds")
+        total += seconds
+    if total > COMMANDS_MAX_DURATION:
+        raise ValueError(f"Batch would take {total:g}s, the limit is {COMMANDS_MAX_DURATION}s")
+    return body
+
+def load_devices(path=DEVICES_CONFIG):
+    """Device registry (id -> Device) from the config file, or the built-in Pico"""
+    if os.path.exists(path):
+        with open(path) as f:
+            entries = json.load(f)
+    else:
+        entries = [{"id": "pico", "address": PICO_ADDRESS}]
+
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"{path}: needs a JSON list with at least one device")
+    seen = set()
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('id') or not entry.get('address'):
+            raise ValueError(f"{path}: device {i} needs an id and an address")
+        if entry['id'] in seen:
+            raise ValueError(f"{path}: device id {entry['id']!r} is used more than once")
+        seen.add(entry['id'])
+
+    devices = {}
+    for i, entry in enumerate(entries):
+        # The first device keeps the module-level sensor_data/state_store
+        shared = {'sensor_data': sensor_data, 'store': state_store} if i == 0 else {}
+        devices[entry['id']] = Device(entry['id'], entry['address'], entry.get('name'), **shared)
+    return devices
+
+
+class CronSpec:
+    """Five-field cron expression: minute hour day-of-month month day-of-week.
+
+    Fields take *, numbers, a-b ranges, comma lists and /step. Day of week
+    is 0-6 from Sunday (7 is Sunday too). As in cron, when both day fields
+    are restricted a day matching either one counts. Times are local.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, lo, hi) for part, (lo, hi) in zip(parts, self.FIELDS))
+        self.weekdays = {d % 7 for d in weekdays}
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+        self.next_after(time.time())  # rejects dates that never happen (e.g. 31 2)
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(','):
+            span, slash, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if span == '*':
+                    start, end = lo, hi
+                elif '-' in span:
+                    start, end = (int(v) for v in span.split('-', 1))
+                else:
+                    start = int(span)
+                    end = hi if slash else start  # "5/15" means 5-max/15
+            except ValueError:
+                raise ValueError(f"Invalid cron field {field!r}")
+            if not lo <= start <= end <= hi or step < 1:
+                raise ValueError(f"Cron field {field!r} out of range {lo}-{hi}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, dt):
+        day = dt.day in self.days
+        weekday = dt.isoweekday() % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, t):
+        """Epoch time of the first matching minute after t"""
+        dt = datetime.fromtimestamp(t).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Skip whole months/days/hours that can't match; a few hundred steps at most
+        for _ in range(10000):
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron expression never matches: {self.expr!r}")
+
+class ScheduledJob:
+    """A recurring feed/water job plus the outcome of its last run"""
+
+    FIELDS = ('cron', 'action', 'device', 'duration', 'enabled')
+    STATS = ('runs', 'failures', 'last_run', 'last_outcome', 'last_error', 'last_lag_ms', 'last_duration_ms')
+
+    def __init__(self, job_id, cron, action, device, duration=SCHEDULE_WATER_DURATION, enabled=True):
+        self.id = job_id
+        self.spec = CronSpec(cron)
+        self.cron = cron
+        self.action = action
+        self.device = device
+        self.duration = duration
+        self.enabled = enabled
+        self.next_run = None
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_outcome = None
+        self.last_error = None
+        self.last_lag_ms = None
+        self.last_duration_ms = None
+
+    def to_dict(self):
+        job = {'id': self.id, 'next_run': self.next_run}
+        for name in self.FIELDS + self.STATS:
+            job[name] = getattr(self, name)
+        return job
+
+class JobScheduler:
+    """Runs ScheduledJobs from a heap ordered by next run time.
+
+    run() sleeps until the earliest job is due or the job set changes, it
+    never polls the list. Jobs act through Device.feed()/Device.water(),
+    the same path as the /feed and /pump_in handlers, and are saved to
+    `path` (JSON) on every change so they survive restarts.
+    """
+
+    ACTIONS = ('feed', 'water')
+
+    def __init__(self, devices, path=SCHEDULE_PATH):
+        self.devices = devices
+        self.path = path
+        self.jobs = {}
+        self._heap = []  # (next_run, job id); stale entries are skipped on pop
+        self._wakeup = asyncio.Event()
+        self._next_id = 1
+        self._running = set()
+
+    def _check(self, fields):
+        unknown = set(fields) - set(ScheduledJob.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown job field(s): {', '.join(sorted(unknown))}")
+        if fields.get('action') not in self.ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(self.ACTIONS)}")
+        if fields.get('device') not in self.devices:
+            raise ValueError(f"Unknown device {fields.get('device')}")
+        duration = fields.get('duration', SCHEDULE_WATER_DURATION)
+        if (not isinstance(duration, (int, float)) or isinstance(duration, bool)
+                or not 0 < duration <= SCHEDULE_MAX_WATER_DURATION):
+            raise ValueError(f"duration must be 0-{SCHEDULE_MAX_WATER_DURATION} seconds")
+        if not isinstance(fields.get('cron'), str):
+            raise ValueError("cron must be a string")
+        return fields
+
+    def _schedule(self, job):
+        job.next_run = job.spec.next_after(time.time()) if job.enabled else None
+        if job.next_run is not None:
+            heapq.heappush(self._heap, (job.next_run, job.id))
+        self._wakeup.set()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        # Called before the web server starts: a bad file must not stop the app
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring {self.path}: {e}")
+            return
+        if not isinstance(entries, list):
+            print(f"Ignoring {self.path}: expected a list of jobs")
+            return
+        for entry in entries:
+            try:
+                if not isinstance(entry, dict):
+                    raise TypeError("expected an object")
+                fields = self._check({k: entry[k] for k in ScheduledJob.FIELDS if k in entry})
+                job = ScheduledJob(str(entry['id']), **fields)
+            except (KeyError, TypeError, ValueError) as e:
+                job_id = entry.get('id') if isinstance(entry, dict) else entry
+                print(f"Skipping scheduled job {job_id}: {e}")
+                continue
+            for name in ScheduledJob.STATS:
+                setattr(job, name, entry.get(name, getattr(job, name)))
+            self.jobs[job.id] = job
+            self._schedule(job)
+        self._next_id = max((int(i) for i in self.jobs if i.isdigit()), default=0) + 1
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump([job.to_dict() for job in self.jobs.values()], f, indent=2)
+        os.replace(tmp, self.path)  # never leave a half-written file behind
+
+    def create(self, fields):
+        fields = self._check(dict(fields))
+        job = ScheduledJob(str(self._next_id), **fields)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        self._schedule(job)
+        self.save()
+        return job
+
+    def update(self, job_id, fields):
+        old = self.jobs[job_id]
+        merged = {name: getattr(old, name) for name in ScheduledJob.FIELDS}
+        merged.update(fields)
+        job = ScheduledJob(job_id, **self._check(merged))
+        for name in ScheduledJob.STATS:
+            setattr(job, name, getattr(old, name))
+        self.jobs[job_id] = job
+        self._schedule(job)
+        self.save()
+        return job
+
+    def delete(self, job_id):
+        del self.jobs[job_id]
+        self._wakeup.set()
+        self.save()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                due, job_id = heapq.heappop(self._heap)
+                job = self.jobs.get(job_id)
+                if job is None or job.next_run != due:
+                    continue  # deleted or rescheduled since it was pushed
+                # Runs missed while the Pi was off or busy are not caught up
+                job.next_run = job.spec.next_after(max(now, due))
+                heapq.heappush(self._heap, (job.next_run, job.id))
+                task = asyncio.create_task(self._execute(job, due))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            timeout = SCHEDULE_MAX_SLEEP
+            if self._heap:
+                timeout = min(timeout, max(0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job, due):
+        device = self.devices.get(job.device)
+        start = time.time()
+        outcome, error = "ok", None
+        try:
+            if device is None:
+                raise KeyError(f"Unknown device {job.device}")
+            if job.action == 'feed':
+                if not device.connected:
+                    raise ConnectionError("BLE not connected")
+                await device.feed()
+            else:
+                await device.water(job.duration)
+        except ConnectionError as e:
+            outcome, error = "disconnected", str(e)
+        except Exception as e:
+            outcome, error = "error", str(e)
+        elapsed = time.time() - start
+        SCHEDULE_LATENCY.observe(elapsed, job.device, job.action)
+        SCHEDULE_RUNS.inc(job.device, job.action, outcome)
+        job.runs += 1
+        job.failures += outcome != "ok"
+        job.last_run = start
+        job.last_outcome = outcome
+        job.last_error = error
+        job.last_lag_ms = round((start - due) * 1000, 1)
+        job.last_duration_ms = round(elapsed * 1000, 1)
+        print(f"Scheduled {job.action} on {job.device} (job {job.id}): {outcome}"
+              + (f" - {error}" if error else ""))
+        if job.id in self.jobs:
+            self.save()
+
+class WindowAggregate:
+    """avg, min or max of the samples from the last `window` seconds.
+
+    Each sample costs O(1) amortized: a running sum for avg, a monotonic
+    deque for min/max, and expired samples drop off the front. Values are
+    raw ints (hundredths), so the sum never drifts.
+    """
+
+    def __init__(self, kind, window):
+        self.kind = kind
+        self.window = window
+        self.samples = deque()  # (timestamp, value)
+        self.extremes = deque()  # candidates for min/max, oldest first
+        self.total = 0
+
+    def add(self, timestamp, value):
+        """Add a sample and return the aggregate over the window ending at it"""
+        self.samples.append((timestamp, value))
+        cutoff = timestamp - self.window
+        if self.kind == 'avg':
+            self.total += value
+            while self.samples[0][0] <= cutoff:
+                self.total -= self.samples.popleft()[1]
+            return self.total / len(self.samples)
+        extremes = self.extremes
+        beaten = operator.ge if self.kind == 'min' else operator.le
+        while extremes and beaten(extremes[-1][1], value):
+            extremes.pop()
+        extremes.append((timestamp, value))
+        while extremes[0][0] <= cutoff:
+            extremes.popleft()
+        while self.samples[0][0] <= cutoff:
+            self.samples.popleft()
+        return extremes[0][1]
+
+class Rule:
+    """An automation rule compiled from its config entry.
+
+    `field op value`, e.g. humidity < 30, is checked on every sample; with
+    `agg` and `window` against the avg/min/max over the last window seconds
+    instead of the sample itself. With `for` the condition has to hold that
+    many seconds before the action runs (a timer covers the case where no
+    new sample arrives, notify mode only sends changes).
+    """
+
+    FIELDS = ('id', 'device', 'field', 'op', 'value', 'agg', 'window', 'for', 'action',
+              'duration', 'cooldown')
+    OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+    SAMPLE_INDEX = {'temperature': 1, 'humidity': 2}  # position in (ts, temp, humidity)
+    def __init__(self, config):
+        unknown = set(config) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown rule field(s): {', '.join(sorted(unknown))}")
+        self.config = config
+        self.id = str(config['id'])
+        if config.get('field') not in self.SAMPLE_INDEX:
+            raise ValueError(f"field must be one of {', '.join(self.SAMPLE_INDEX)}")
+        if config.get('op') not in self.OPS:
+            raise ValueError(f"op must be one of {' '.join(self.OPS)}")
+        if config.get('action') not in DEVICE_ACTIONS:
+            raise ValueError(f"action must be one of {', '.join(DEVICE_ACTIONS)}")
+        self.index = self.SAMPLE_INDEX[config['field']]
+        self.compare = self.OPS[config['op']]
+        try:
+            value = float(config['value'])
+        except (TypeError, ValueError):
+            raise ValueError("value must be a number")
+        if not math.isfinite(value):
+            raise ValueError("value must be a finite number")
+        self.threshold = round(value * 100)  # raw hundredths, like the samples
+        self.act = DEVICE_ACTIONS[config['action']]
+        self.hold = self._seconds(config, 'for', 0)
+        self.duration = self._seconds(config, 'duration', RULE_WATER_DURATION)
+        self.cooldown = self._seconds(config, 'cooldown', RULE_COOLDOWN)
+        self.aggregate = None
+        if config.get('agg') is not None:
+            if config['agg'] not in ('avg', 'min', 'max'):
+                raise ValueError("agg must be avg, min or max")
+            self.aggregate = WindowAggregate(config['agg'], self._seconds(config, 'window', None, positive=True))
+        self.since = None  # when the condition last became true
+        self.armed = True  # false from firing until the condition clears
+        self.next_allowed = 0.0
+        self._timer = None
+        self.task = None
+        self.evaluations = 0
+        self.cpu_ns = 0
+        self.fired = 0
+        self.last_fired = None
+        self.last_outcome = None
+        self.last_error = None
+
+    @staticmethod
+    def _seconds(config, key, default, positive=False):
+        try:
+            value = float(config.get(key, default))
+        except (TypeError, ValueError):
+            raise ValueError(f"{key} must be a number of seconds")
+        if not math.isfinite(value) or value < 0 or (positive and value == 0):
+            raise ValueError(f"{key} must be {'more than 0' if positive else '0 or more'} seconds")
+        return value
+
+    def evaluate(self, timestamp, sample):
+        """Feed one sample; returns True when the action should run now"""
+        value = sample[self.index]
+        if self.aggregate is not None:
+            value = self.aggregate.add(timestamp, value)
+        if not self.compare(value, self.threshold):
+            self.since = None
+            self.armed = True
+            self.cancel_timer()
+            return False
+        if self.since is None:
+            self.since = timestamp
+        return self.ready(timestamp)
+
+    def ready(self, now):
+        return self.armed and now - self.since >= self.hold and now >= self.next_allowed
+
+    def cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def to_dict(self):
+        rule = dict(self.config)
+        rule.update({
+            'evaluations': self.evaluations,
+            'cpu_ns_per_sample': round(self.cpu_ns / self.evaluations) if self.evaluations else None,
+            'active': self.since is not None,
+            'fired': self.fired,
+            'last_fired': self.last_fired,
+            'last_outcome': self.last_outcome,
+            'last_error': self.last_error,
+        })
+        return rule
+
+class RuleEngine:
+    """Evaluates one device's rules incrementally as SensorData records samples.
+
+    SensorData calls on_sample() with each raw (timestamp, temp, humidity)
+    sample; every rule does O(1) work per sample and keeps its own CPU time
+    so /rules can show what each rule costs.
+    """
+
+    def __init__(self, device, rules):
+        self.device = device
+        self.rules = rules
+
+    def on_sample(self, timestamp, temp_raw, humidity_raw):
+        sample = (timestamp, temp_raw, humidity_raw)
+        for rule in self.rules:
+            start = time.perf_counter_ns()
+            try:
+                fire = rule.evaluate(timestamp, sample)
+            except Exception as e:
+                # A broken rule must not stop ingest (or the other rules)
+                if rule.last_error != str(e):
+                    print(f"Rule {rule.id} on {self.device.id} failed: {e}")
+                rule.last_outcome, rule.last_error = "error", str(e)
+                continue
+            finally:
+                rule.cpu_ns += time.perf_counter_ns() - start
+            rule.evaluations += 1
+            if fire:
+                self._fire(rule)
+            elif rule.since is not None and rule.hold and rule._timer is None and rule.armed:
+                # Check again when the hold time is up, even if no sample comes
+                delay = max(0, rule.since + rule.hold - time.time())
+                rule._timer = asyncio.get_running_loop().call_later(delay, self._on_hold, rule)
+
+    def _on_hold(self, rule):
+        rule._timer = None
+        if rule.since is not None and rule.ready(time.time()):
+            self._fire(rule)
+
+    def _fire(self, rule):
+        rule.armed = False
+        rule.cancel_timer()
+        if rule.task is not None and not rule.task.done():
+            return  # previous run (e.g. a long water) still going
+        rule.next_allowed = time.time() + rule.cooldown
+        rule.task = asyncio.create_task(self._run(rule))
+
+    async def _run(self, rule):
+        rule.fired += 1
+        rule.last_fired = time.time()
+        try:
+            if not self.device.connected:
+                raise ConnectionError("BLE not connected")
+            await rule.act(self.device, rule.duration)
+            rule.last_outcome, rule.last_error = "ok", None
+        except ConnectionError as e:
+            rule.last_outcome, rule.last_error = "disconnected", str(e)
+        except Exception as e:
+            rule.last_outcome, rule.last_error = "error", str(e)
+        print(f"Rule {rule.id} on {self.device.id}: {rule.config['action']} {rule.last_outcome}"
+              + (f" - {rule.last_error}" if rule.last_error else ""))
+
+def load_rules(devices, path=RULES_CONFIG):
+    """Compile the rules in the config file and attach a RuleEngine per device"""
+    if not os.path.exists(path):
+        return
+    # Called before the web server starts: a bad file must not stop the app
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring {path}: {e}")
+        return
+    if not isinstance(entries, list):
+        print(f"Ignoring {path}: expected a list of rules")
+        return
+    default = next(iter(devices))
+    per_device = {}
+    for entry in entries:
+        try:
+            if not isinstance(entry, dict):
+                raise TypeError("expected an object")
+            device_id = entry.setdefault('device', default)
+            if device_id not in devices:
+                raise ValueError(f"Unknown device {device_id}")
+            per_device.setdefault(device_id, []).append(Rule(entry))
+        except (KeyError, TypeError, ValueError) as e:
+            rule_id = entry.get('id') if isinstance(entry, dict) else entry
+            print(f"Skipping rule {rule_id}: {e}")
+    for device_id, rules in per_device.items():
+        device = devices[device_id]
+        device.sensor_data.rules = RuleEngine(device, rules)
+    print(f"Loaded {sum(len(r) for r in per_device.values())} automation rule(s)")
+
+async def web_server(devices, port=PORT, scheduler=None):
     """Start the web server and handle requests."""
-    app = web.Application(middlewares=[error_middleware])
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware])
     
-    app['ble_client'] = ble_client  # Store BLE client in app context
-    app['pump_in'] = False
-    app['pump_out'] = False
-    app['led_state'] = False
-    app['last_fed'] = "Never"
-    app['last_watered'] = "Never"
+    app['devices'] = devices
+    app['default_device'] = next(iter(devices))  # served at the un-prefixed URLs
     
-    # Add new route for LED control
-    app.router.add_get('/', handle_root)
-    app.router.add_get('/pump_in/{action}', handle_pump_in)
-    app.router.add_get('/pump_out/{action}', handle_pump_out)
-    app.router.add_get('/led/{state}', handle_led)  
-    app.router.add_get('/status', handle_status)   
-    app.router.add_get('/feed', handle_feed)
+    # Every page/endpoint is available for the default device at / and for
+    # each device under /devices/{device_id}/
+    app.router.add_get('/devices', handle_devices)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/rules', handle_rules)
+    app.router.add_get('/static/{name}', handle_static)
+    app['static'] = static_assets
+    app['static_build'] = asyncio.create_task(static_assets.build())
+    for prefix in ('', '/devices/{device_id}'):
+        app.router.add_get(prefix + '/', handle_root)
+        app.router.add_get(prefix + '/pump_in/{action}', handle_pump_in)
+        app.router.add_get(prefix + '/pump_out/{action}', handle_pump_out)
+        app.router.add_get(prefix + '/led/{state}', handle_led)
+        app.router.add_get(prefix + '/status', handle_status)
+        app.router.add_get(prefix + '/feed', handle_feed)
+        app.router.add_get(prefix + '/gatt', handle_gatt_stats)
+        app.router.add_get(prefix + '/ble', handle_ble_stats)
+        app.router.add_get(prefix + '/sampling', handle_sampling_stats)
+        app.router.add_get(prefix + '/events', handle_events)
+        app.router.add_get(prefix + '/history', handle_history)
+        app.router.add_post(prefix + '/commands', handle_commands)
+    if scheduler is not None:
+        app['scheduler'] = scheduler
+        app.router.add_get('/schedule', handle_schedule_list)
+        app.router.add_post('/schedule', handle_schedule_create)
+        app.router.add_get('/schedule/{job_id}', handle_schedule_get)
+        app.router.add_put('/schedule/{job_id}', handle_schedule_update)
+        app.router.add_delete('/schedule/{job_id}', handle_schedule_delete)
     
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 8080)
+    site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
-    print(f"Server running on http://{get_ip()}:8080")  # Now using the defined function
+    print(f"Server running on http://{get_ip()}:{port}")  # Now using the defined function
     
     # Run forever
     while True:
         await asyncio.sleep(3600)
 
+def _device(request):
+    """Device addressed by the request URL (the default one for un-prefixed URLs)"""
+    device_id = request.match_info.get('device_id', request.app['default_device'])
+    try:
+        return request.app['devices'][device_id]
+    except KeyError:
+        raise web.HTTPNotFound(text=f"Unknown device {device_id}")
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Latency histogram and status counter per handler"""
+    name = handler.__name__
+    status = 500
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as ex:
+        status = ex.status
+        raise
+    finally:
+        HTTP_LATENCY.observe(time.perf_counter() - start, name)
+        HTTP_REQUESTS.inc(name, status)
+
 @web.middleware
 async def error_middleware(request, handler):
     """Middleware to handle errors and return JSON responses."""
@@ -285,151 +2429,661 @@ async def error_middleware(request, handler):
             "status": 500
         }, status=500)
 
+def _job(request):
+    job_id = request.match_info['job_id']
+    try:
+        return request.app['scheduler'].jobs[job_id]
+    except KeyError:
+        raise web.HTTPNotFound(text=f"Unknown job {job_id}")
+
+async def _json_body(request):
+    try:
+        return await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Body must be JSON")
+
+async def _job_fields(request):
+    fields = await _json_body(request)
+    if not isinstance(fields, dict):
+        raise web.HTTPBadRequest(text="Body must be a JSON object")
+    return fields
+
+async def handle_schedule_list(request):
+    return web.json_response([job.to_dict() for job in request.app['scheduler'].jobs.values()])
+
+async def handle_schedule_get(request):
+    return web.json_response(_job(request).to_dict())
+
+async def handle_schedule_create(request):
+    """Add a job: {"cron": "0 7 * * *", "action": "feed"|"water", "device", "duration", "enabled"}"""
+    fields = await _job_fields(request)
+    fields.setdefault('device', request.app['default_device'])
+    try:
+        job = request.app['scheduler'].create(fields)
+    except (TypeError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response(job.to_dict(), status=201)
+
+async def handle_schedule_update(request):
+    """Change some fields of a job; it is rescheduled from now"""
+    job = _job(request)
+    fields = await _job_fields(request)
+    try:
+        job = request.app['scheduler'].update(job.id, fields)
+    except (TypeError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    return web.json_response(job.to_dict())
+
+async def handle_schedule_delete(request):
+    job = _job(request)
+    request.app['scheduler'].delete(job.id)
+    return web.Response(status=204)
+
+async def handle_rules(request):
+    """Automation rules with their state, outcome and CPU cost per sample"""
+    rules = []
+    for device in request.app['devices'].values():
+        if device.sensor_data.rules is not None:
+            rules.extend(rule.to_dict() for rule in device.sensor_data.rules.rules)
+    return web.json_response(rules)
+
+async def handle_devices(request):
+    """List the configured Picos"""
+    devices = []
+    for device in request.app['devices'].values():
+        state = device.store.state
+        devices.append({
+            'id': device.id,
+            'name': device.name,
+            'address': device.address,
+            'connected': device.connected,
+            'state': state.ble_state,
+            'temperature': state.temperature,
+            'humidity': state.humidity,
+        })
+    return web.json_response(devices)
+
+async def handle_metrics(request):
+    """Prometheus text exposition of the histograms/counters plus per-device gauges"""
+    devices = request.app['devices'].values()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines += render_gauge('ble_connected', '1 while the BLE link is up', ('device',),
+                          [((d.id,), int(d.connected)) for d in devices])
+    lines += render_gauge('ble_uptime_seconds', 'Length of the current BLE session', ('device',),
+                          [((d.id,), d.ble.metrics()['uptime_s']) for d in devices])
+    lines += render_gauge('ble_last_reconnect_seconds', 'Time the last (re)connect took', ('device',),
+                          [((d.id,), d.ble.last_reconnect_time) for d in devices
+                           if d.ble.last_reconnect_time is not None])
+    lines += render_gauge('ble_disconnects_total', 'Link drops since startup', ('device',),
+                          [((d.id,), d.ble.disconnects) for d in devices], kind="counter")
+    lines += render_gauge('poll_interval_seconds', 'Current sensor poll interval', ('device',),
+                          [((d.id,), d.sampler.interval) for d in devices])
+    lines += render_gauge('poll_reads_saved_total', 'Characteristic reads saved by adaptive polling', ('device',),
+                          [((d.id,), round(d.sampler.reads_saved)) for d in devices], kind="counter")
+    lines += render_gauge('gatt_queue_depth', 'GATT operations waiting in the scheduler', ('device',),
+                          [((d.id,), d.gatt.stats()['queue_depth']) for d in devices])
+    rules = [(d.id, rule) for d in devices if d.sensor_data.rules is not None for rule in d.sensor_data.rules.rules]
+    lines += render_gauge('rule_eval_cpu_seconds_total', 'CPU time spent evaluating each rule', ('device', 'rule'),
+                          [((device_id, r.id), r.cpu_ns / 1e9) for device_id, r in rules], kind="counter")
+    lines += render_gauge('rule_fired_total', 'Times each rule ran its action', ('device', 'rule'),
+                          [((device_id, r.id), r.fired) for device_id, r in rules], kind="counter")
+    response = web.Response(body=("\n".join(lines) + "\n").encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    response.enable_compression()
+    return response
+
+async def handle_static(request):
+    """Static files: resized variant for ?w=, WebP when the browser takes it, sent with sendfile"""
+    assets = request.app['static']
+    name = request.match_info['name']
+    if name not in assets.files:
+        raise web.HTTPNotFound()
+    try:
+        width = int(request.query['w']) if 'w' in request.query else None
+    except ValueError:
+        return web.Response(text="w must be an integer", status=400)
+
+    path, content_type = assets.resolve(name, width, request.headers.get('Accept', ''))
+    headers = {'Vary': 'Accept'}
+    if content_type:
+        headers['Content-Type'] = content_type
+    if width is not None and content_type is None:
+        headers['Cache-Control'] = f'public, max-age={STATIC_FALLBACK_MAX_AGE}'
+    elif request.query.get('v') == assets.version(name):
+        headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    else:
+        headers['Cache-Control'] = 'public, max-age=86400'
+    # FileResponse uses sendfile and answers If-None-Match/If-Modified-Since itself
+    return web.FileResponse(path, headers=headers)
+
+def _time_format(request):
+    """?time=text (default, as on the page), iso or epoch"""
+    time_format = request.query.get('time', 'text')
+    if time_format not in ('text', 'iso', 'epoch'):
+        raise web.HTTPBadRequest(text="time must be text, iso or epoch")
+    return time_format
+
+# DeviceState fields /status reports (the readings have their own endpoints)
+STATUS_FIELDS = ('pump_in', 'pump_out', 'led_state', 'last_fed', 'last_watered', 'ble_state')
+
 async def handle_status(request):
     """ set up JSON for the status """
-    return web.json_response({
-        'pump_in': request.app['pump_in'],
-        'pump_out': request.app['pump_out'],
-        'led_state': request.app['led_state'],  
-        'last_fed': request.app['last_fed'],
-        'last_watered': request.app['last_watered']
+    device = _device(request)
+    time_format = _time_format(request)
+    state = device.store.state
+    status = {field: getattr(state, field) for field in STATUS_FIELDS}
+    if time_format != 'text':
+        return web.json_response(_present_times(status, time_format))
+    version = state.version
+    if device.status_cache.get(version) is None:
+        device.status_cache.put(version, json.dumps(_present_times(status)).encode())
+    return _cached_response(request, device.status_cache, 'application/json')
+
+async def handle_events(request):
+    """Server-Sent Events: full state once, then only the values that change"""
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+    device = _device(request)
+    time_format = _time_format(request)
+    await response.prepare(request)
+
+    sub = device.store.subscribe()
+    sent = {}
+    changes = device.store.state.as_dict()
+    try:
+        while True:
+            delta = {k: v for k, v in changes.items() if k not in sent or sent[k] != v}
+            if delta:
+                sent.update(delta)
+                await response.write(f"data: {json.dumps(_present_times(delta, time_format))}\n\n".encode())
+            else:
+                await response.write(b": keepalive\n\n")
+            changes = await sub.next(timeout=EVENTS_KEEPALIVE)
+    except ConnectionResetError:
+        pass  # browser tab closed
+    finally:
+        device.store.unsubscribe(sub)
+    return response
+
+async def handle_history(request):
+    """Downsampled temperature/humidity history, e.g. /history?from=...&to=...&step=60
+
+    from/to are epoch seconds (default: the last hour), step is seconds per point.
+    """
+    device = _device(request)
+    try:
+        t_to = int(request.query.get('to', time.time()))
+        t_from = int(request.query.get('from', t_to - 3600))
+        step = int(request.query.get('step', 60))
+    except ValueError:
+        return web.Response(text="from, to and step must be integers", status=400)
+    if t_from >= t_to or step <= 0:
+        return web.Response(text="Need from < to and step > 0", status=400)
+
+    step, points = device.sensor_data.history.query(t_from, t_to, step)
+    response = web.json_response({
+        'from': t_from,
+        'to': t_to,
+        'step': step,
+        'points': points,
     })
+    response.enable_compression()  # differs per query, compressed on the fly
+    return response
+
+async def handle_gatt_stats(request):
+    """GATT scheduler queue depth and wait times"""
+    device = _device(request)
+    stats = device.gatt.stats()
+    stats['actuator_writes'] = device.actuators.writes
+    stats['actuator_writes_dropped'] = device.actuators.dropped
+    return web.json_response(stats)
+
+async def handle_ble_stats(request):
+    """Connection state, reconnect time and uptime of the BLE link"""
+    return web.json_response(_device(request).ble.metrics())
+
+async def handle_sampling_stats(request):
+    """Current poll interval, reads saved and change detection latency"""
+    return web.json_response(_device(request).sampler.stats())
+
 async def handle_led(request):
     """Handle LED control of the app to the Pico via BLE"""
+    device = _device(request)
+    if not device.connected:
+        return web.Response(text="BLE not connected", status=503)
     try:
         action = request.match_info['state']
-        request.app['led_state'] = (action == 'on')
-        
-        # Get BLE client from app context
-        ble_client = request.app['ble_client']
-        
-        if ble_client and ble_client.is_connected:
-            led_value = b"\x01" if (action == 'on') else b"\x00"
-            await ble_client.write_gatt_char(LED_CONTROL_UUID, led_value)
-            return web.Response(text=f"LED set to {action.upper()}")
-        else:
-            return web.Response(text="BLE not connected", status=503)
+        await device.set_led(action == 'on')
+        return web.Response(text=f"LED set to {action.upper()}")
             
     except KeyError:
         return web.Response(text="Missing state parameter", status=400)
+    except ConnectionError as e:
+        return web.Response(text=f"BLE not connected: {e}", status=503)
     except Exception as e:
         return web.Response(text=f"Error: {str(e)}", status=500)
 
 async def handle_feed(request):
-    try:
-        ble_client = request.app['ble_client']
-        if ble_client and ble_client.is_connected:
-            # Write feed command
-            await ble_client.write_gatt_char(MANUAL_FEED_BIRDS_UUID, b"\x01")
-            # Update timestamp
-            request.app['last_fed'] = _decode_time(await ble_client.read_gatt_char(FEED_BIRDS_UUID))
-            return web.Response(text="Birds fed successfully")
+    device = _device(request)
+    if not device.connected:
         return web.Response(text="BLE not connected", status=503)
+    try:
+        await device.feed()
+        return web.Response(text="Birds fed successfully")
+    except ConnectionError as e:
+        return web.Response(text=f"BLE not connected: {e}", status=503)
     except Exception as e:
         return web.Response(text=f"Error: {str(e)}", status=500)
 
 async def handle_pump_in(request):
     """Handle pump in control"""
+    device = _device(request)
+    if not device.connected:
+        return web.Response(text="BLE not connected", status=503)
     try:
         action = request.match_info['action']
-        request.app['pump_in'] = (action == 'on')
-        ble_client = request.app['ble_client']
-        if ble_client and ble_client.is_connected:
-            pump_value = b"\x01" if (action == 'on') else b"\x00"
-            await ble_client.write_gatt_char(PUMP_CONTROL_UUID, pump_value)
-            request.app['last_watered'] = _decode_time(await ble_client.read_gatt_char(WATER_BIRDS_UUID))
+        await device.set_pump_in(action == 'on')
         return web.Response(text=f"Pump IN set to {action.upper()}")
     except KeyError:
         return web.Response(text="Missing action parameter", status=400)
+    except ConnectionError as e:
+        return web.Response(text=f"BLE not connected: {e}", status=503)
     except Exception as e:
         return web.Response(text=f"Error: {str(e)}", status=500)
 
 async def handle_pump_out(request):
     """Handle pump out control"""
+    device = _device(request)
+    if not device.connected:
+        return web.Response(text="BLE not connected", status=503)
     try:
         action = request.match_info['action']
-        request.app['pump_out'] = (action == 'on')
-        ble_client = request.app['ble_client']
-        if ble_client and ble_client.is_connected:
-            pump_value = b"\x11" if (action == 'on') else b"\x10"
-            await ble_client.write_gatt_char(PUMP_CONTROL_UUID, pump_value)
+        await device.set_pump_out(action == 'on')
         return web.Response(text=f"Pump OUT set to {action.upper()}")
     except KeyError:
         return web.Response(text="Missing action parameter", status=400)
+    except ConnectionError as e:
+        return web.Response(text=f"BLE not connected: {e}", status=503)
     except Exception as e:
         return web.Response(text=f"Error: {str(e)}", status=500)
 
+async def handle_commands(request):
+    """Run a list of actions/delays in order, streaming one JSON line per step.
+
+    The whole batch is checked before anything runs. Once started it runs
+    to the end (or first failure) even if the client goes away, so a
+    pump switched on is also switched off again.
+    """
+    device = _device(request)
+    try:
+        steps = parse_commands(await _json_body(request))
+    except ValueError as e:
+        return web.Response(text=str(e), status=400)
+    if not device.connected:
+        return web.Response(text="BLE not connected", status=503)
+
+    results = asyncio.Queue()
+    run = asyncio.create_task(device.run_commands(steps, results.put_nowait))
+    device.command_runs.add(run)
+    run.add_done_callback(device.command_runs.discard)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    try:
+        while True:
+            result = await results.get()
+            await response.write(json.dumps(result).encode() + b"\n")
+            if result.get('done'):
+                break
+        await response.write_eof()
+    except ConnectionResetError:
+        pass  # client gone, the batch keeps running
+    return response
+
 async def handle_root(request):
-    
-    temp, humidity, fed_time, water_time = await sensor_data.get_values()
-    
-    html = HTML_TEMPLATE % (
-        temp,
-        humidity,
-        fed_time,
-        water_time,
-        "ON" if request.app['pump_in'] else "OFF",
-        "ON" if request.app['pump_out'] else "OFF",
-        "ON" if request.app['led_state'] else "OFF"
-    )
-    return web.Response(text=html, content_type='text/html')
+    """Dashboard page, rendered (and compressed) once per state version, served with an ETag"""
+    device = _device(request)
+    state = device.store.state
+    cache = device.page_cache
+    if cache.get(state.version) is None:
+        html = HTML_BODY_TEMPLATE % (
+            state.temperature,
+            state.humidity,
+            format_time(state.last_fed),
+            format_time(state.last_watered),
+            "ON" if state.pump_in else "OFF",
+            "ON" if state.pump_out else "OFF",
+            "ON" if state.led_state else "OFF",
+            state.ble_state,
+        )
+        cache.put(state.version, html.encode())
+    return _cached_response(request, cache, 'text/html')
 
-def _decode_time(data):
-    """Decode time from 8-byte format (seconds since epoch * 10^7)."""
+def _decode_sensor_frame(data):
+    """Decode a SENSOR_FRAME into (temperature, humidity, last_fed, last_watered)"""
+    temp, humidity, fed_ticks, water_ticks = SENSOR_FRAME.unpack(data)
+    return temp / 100, humidity / 100, fed_ticks / 10_000_000, water_ticks / 10_000_000
+
+# Characteristics BLE_task keeps SensorData in sync with: uuid -> (field, decoder)
+SENSOR_CHARS = {
+    TEMP_CHAR_UUID: ("temperature", _decode_temperature),
+    HUMIDITY_CHAR_UUID: ("humidity", _decode_temperature),
+    FEED_BIRDS_UUID: ("last_fed", _decode_time),
+    WATER_BIRDS_UUID: ("last_watered", _decode_time),
+}
+
+def _supports_notify(ble_client, uuid):
+    """Check the characteristic properties from service discovery, if we have them"""
     try:
-        if len(data) != 8:  # Ensure 8 bytes are received
-            print(f"Invalid data length: {len(data)} bytes (expected 8)")
-            return None
-        time_in_ticks = struct.unpack("<q", data)[0]  # Unpack 8-byte integer
-        time_in_seconds = time_in_ticks / 10_000_000  # Convert back to seconds
-        converted_time = time.strftime(
-            "%a, %d %b %Y %H:%M:%S", time.gmtime(time_in_seconds - 14400)
+        char = ble_client.services.get_characteristic(uuid)
+    except Exception:
+        return True  # no service table, let start_notify decide
+    if char is None:
+        return False
+    return "notify" in char.properties or "indicate" in char.properties
+
+def _has_characteristic(ble_client, uuid):
+    """True/False from service discovery, None if there's no service table to ask"""
+    try:
+        return ble_client.services.get_characteristic(uuid) is not None
+    except Exception:
+        return None
+
+def _make_notify_handler(uuid, target):
+    if uuid == SENSOR_FRAME_UUID:
+        async def frame_handler(sender, data):
+            await target.update(*_decode_sensor_frame(data))
+        return frame_handler
+    field, decoder = SENSOR_CHARS[uuid]
+
+    async def handler(sender, data):
+        await target.set_value(field, decoder(data))
+    return handler
+
+async def subscribe_notifications(ble_client, uuids=SENSOR_CHARS, target=None):
+    """Start notifications on the sensor characteristics.
+
+    Returns the list of UUIDs that can't notify and have to be polled instead.
+    """
+    target = target or sensor_data
+    polled = []
+    for uuid in uuids:
+        if not _supports_notify(ble_client, uuid):
+            polled.append(uuid)
+            continue
+        try:
+            await ble_client.start_notify(uuid, _make_notify_handler(uuid, target))
+        except Exception as e:
+            print(f"Notify not available for {uuid}, polling instead: {e}")
+            polled.append(uuid)
+    return polled
+
+async def _read_chars(ble_client, uuids):
+    """Read several characteristics, batched when the client is a GATTScheduler"""
+    if hasattr(ble_client, "read_gatt_chars"):
+        return await ble_client.read_gatt_chars(uuids)
+    return [await ble_client.read_gatt_char(uuid) for uuid in uuids]
+
+async def poll_characteristics(ble_client, uuids, target=None):
+    """Read and decode the given characteristics into SensorData"""
+    target = target or sensor_data
+    uuids = list(uuids)
+    if uuids == [SENSOR_FRAME_UUID]:
+        await target.update(*_decode_sensor_frame(await ble_client.read_gatt_char(SENSOR_FRAME_UUID)))
+        return
+    values = await _read_chars(ble_client, uuids)
+    if uuids == list(SENSOR_CHARS):
+        # Full set: one update, same as the original poll loop
+        temp_data, humidity_data, bird_fed_time, bird_water_time = values
+        await target.update(
+            _decode_temperature(temp_data),
+            _decode_temperature(humidity_data),
+            _decode_time(bird_fed_time),
+            _decode_time(bird_water_time),
         )
-        return converted_time
+        return
+    for uuid, data in zip(uuids, values):
+        field, decoder = SENSOR_CHARS[uuid]
+        await target.set_value(field, decoder(data))
+
+def _polled_fields(uuids):
+    """DeviceState fields a poll of these characteristics refreshes"""
+    if list(uuids) == [SENSOR_FRAME_UUID]:
+        return tuple(field for field, _ in SENSOR_CHARS.values())
+    return tuple(SENSOR_CHARS[uuid][0] for uuid in uuids)
+
+class AdaptiveSampler:
+    """Poll interval for BLE_task that stretches while readings are stable.
+
+    after_poll() compares the polled fields with the previous poll: a change
+    beyond POLL_STABLE_DELTA, or a running pump, resets the interval to
+    POLL_INTERVAL, otherwise it grows by POLL_BACKOFF up to POLL_INTERVAL_MAX.
+    sleep() also ends early when a pump is switched on.
+
+    A change is seen at most one gap after it happened, so the gap before the
+    detecting poll is kept as its (worst case) detection latency. Reads saved
+    are counted from the interval slept, against polling every POLL_INTERVAL.
+    """
+
+    def __init__(self, store, name="pico", min_interval=None, max_interval=None,
+                 factor=None, thresholds=None):
+        # Defaults are read here, not at definition, so changed settings apply
+        self.store = store
+        self.name = name
+        self.min_interval = POLL_INTERVAL if min_interval is None else min_interval
+        if max_interval is None:
+            max_interval = POLL_INTERVAL_MAX if POLL_ADAPTIVE else self.min_interval
+        self.max_interval = max_interval
+        self.factor = POLL_BACKOFF if factor is None else factor
+        self.thresholds = POLL_STABLE_DELTA if thresholds is None else thresholds
+        self.polls = 0
+        self.reads = 0
+        self.reads_saved = 0.0
+        self.changes = 0
+        self.detect_total = 0.0
+        self.detect_max = 0.0
+        self.reset()
+
+    def reset(self):
+        """Start over at the shortest interval (new BLE session)"""
+        self.interval = self.min_interval
+        self._last_poll = None  # monotonic time of the previous poll
+        self._last_state = None
+
+    def _changed(self, before, after, fields):
+        for field in fields:
+            old, new = getattr(before, field), getattr(after, field)
+            if field in self.thresholds:
+                if abs(new - old) > self.thresholds[field]:
+                    return True
+            elif new != old:
+                return True
+        return False
+
+    @staticmethod
+    def _active(state):
+        return state.pump_in or state.pump_out
+
+    def after_poll(self, fields, reads, now=None):
+        """Account for a poll of `reads` characteristics and pick the next interval"""
+        now = time.monotonic() if now is None else now
+        state = self.store.state
+        changed = False
+        if self._last_poll is not None:
+            gap = now - self._last_poll
+            # The interval slept, not the gap, which includes the GATT reads;
+            # sleep() drops it to the minimum when a pump cuts it short
+            self.reads_saved += reads * (self.interval / self.min_interval - 1)
+            changed = self._changed(self._last_state, state, fields)
+            if changed:
+                self.changes += 1
+                self.detect_total += gap
+                self.detect_max = max(self.detect_max, gap)
+                POLL_DETECT_LATENCY.observe(gap, self.name)
+        self._last_poll, self._last_state = now, state
+        self.polls += 1
+        self.reads += reads
+        if changed or self._active(state):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        return self.interval
+
+    async def sleep(self):
+        """Wait out the interval, or until a pump is switched on"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.interval
+        sub = self.store.subscribe()
+        try:
+            while loop.time() < deadline:
+                changes = await sub.next(timeout=deadline - loop.time())
+                if changes.get('pump_in') or changes.get('pump_out'):
+                    self.interval = self.min_interval
+                    return
+        finally:
+            self.store.unsubscribe(sub)
+
+    def stats(self):
+        return {
+            'adaptive': self.max_interval > self.min_interval,
+            'interval_s': self.interval,
+            'polls': self.polls,
+            'reads': self.reads,
+            'reads_saved': round(self.reads_saved),
+            'changes': self.changes,
+            'avg_detect_s': round(self.detect_total / self.changes, 2) if self.changes else None,
+            'max_detect_s': round(self.detect_max, 2),
+        }
+
+async def _sensor_uuids(ble_client, target):
+    """[SENSOR_FRAME_UUID] if the Pico serves a usable frame, else the per-value UUIDs.
+
+    Reads the frame once to check it, which also seeds SensorData.
+    """
+    if not BLE_SENSOR_FRAME or _has_characteristic(ble_client, SENSOR_FRAME_UUID) is False:
+        return list(SENSOR_CHARS)
+    try:
+        await poll_characteristics(ble_client, [SENSOR_FRAME_UUID], target)
     except Exception as e:
-        print(f"Error decoding time: {e}")
-        return None
+        if not ble_client.is_connected:
+            raise
+        print(f"Sensor frame not usable, reading characteristics one by one: {e}")
+        return list(SENSOR_CHARS)
+    return [SENSOR_FRAME_UUID]
 
 # Update BLE_task to maintain connection
-async def BLE_task(ble_client):
+async def BLE_task(ble_client, mode=None, target=None, address=PICO_ADDRESS, sampler=None):
+    mode = mode or BLE_INGEST_MODE
     while True:
         try:
         
-            print(f"Connected to Pico at {PICO_ADDRESS}")
+            print(f"Connected to Pico at {address}")
+            if sampler is not None:
+                sampler.reset()
+            sensors = await _sensor_uuids(ble_client, target)
+            polled = sensors
+            if mode == "notify":
+                polled = await subscribe_notifications(ble_client, sensors, target)
+                # Seed the notified values once, they only arrive on change
+                await poll_characteristics(ble_client, sensors, target)
+                print(f"Notifications active, polling {len(polled)} characteristic(s)")
+            fields = _polled_fields(polled)
             while True:
-                # Read actual sensor data
-                temp_data = await ble_client.read_gatt_char(TEMP_CHAR_UUID)
-                humidity_data = await ble_client.read_gatt_char(HUMIDITY_CHAR_UUID)
-                bird_fed_time = await ble_client.read_gatt_char(FEED_BIRDS_UUID)
-                bird_water_time = await ble_client.read_gatt_char(WATER_BIRDS_UUID)
-                # Decode values
-                temp = _decode_temperature(temp_data)
-                humidity = _decode_temperature(humidity_data)
-                #print(f"Temperature: {temp:.2f}°C, Humidity: {humidity:.2f}%")
-                
-                # Update shared sensor data
-                await sensor_data.update(temp, humidity, _decode_time(bird_fed_time), _decode_time(bird_water_time))
+                if polled:
+                    await poll_characteristics(ble_client, polled, target)
+                    if sampler is not None:
+                        sampler.after_poll(fields, len(polled))
+                #print(f"Temperature: {sensor_data.temperature:.2f}°C, Humidity: {sensor_data.humidity:.2f}%")
                 
-                await asyncio.sleep(2)
+                if sampler is not None:
+                    await sampler.sleep()
+                else:
+                    await asyncio.sleep(POLL_INTERVAL)
                     
         except Exception as e:
             print(f"BLE error: {e}")
+            if not ble_client.is_connected:
+                return  # link is gone, BLEController reconnects
             await asyncio.sleep(5)
 
+async def run_device(device, radio=None, connect_lock=None, start_delay=0, client_factory=None):
+    """Keep one Pico connected and its SensorData in sync"""
+    # Staggered start spreads connects and poll cycles of the devices apart
+    await asyncio.sleep(start_delay)
+    if client_factory is not None:
+        device.ble.client_factory = client_factory
+    device.ble.connect_lock = connect_lock
+
+    async def session(client):
+        device.attach(client, radio)
+        await device.actuators.reapply()
+        await BLE_task(device.gatt, target=device.sensor_data, address=device.address,
+                       sampler=device.sampler)
+
+    await device.ble.run(session)
+
+def _device_path(path, index, device):
+    """First device uses path as is, others get their own file next to it"""
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{device.id}{ext}"
+
 # Update main to properly handle shutdown
 async def main():
-     # Initialize BLE client first
-    ble_client = BleakClient(PICO_ADDRESS)
-    await ble_client.connect()
-    
-    # Pass BLE client to web server
-    t1 = asyncio.create_task(BLE_task(ble_client))
-    t2 = asyncio.create_task(web_server(ble_client))
-    
-    await asyncio.gather(t1, t2)
+    devices = load_devices()
+
+    scheduler = JobScheduler(devices)
+    scheduler.load()
+    load_rules(devices)
+
+    # Serve the dashboard straight away, devices show up as they connect
+    tasks = [asyncio.create_task(web_server(devices, PORT, scheduler)),
+             asyncio.create_task(scheduler.run())]
+    for i, device in enumerate(devices.values()):
+        if SENSOR_LOG_PATH:
+            log = SensorLog(_device_path(SENSOR_LOG_PATH, i, device))
+            try:
+                await log.open()
+                await log.restore(device.sensor_data.history)
+            except Exception as e:
+                # Read-only SD card, locked or corrupt database: run without history
+                print(f"Sensor log {log.path} unavailable, not persisting samples: {e}")
+                await log.close()
+                continue
+            device.sensor_data.log = log
+            tasks.append(asyncio.create_task(log.run()))
+
+    # Each device gets its own scheduler; they share the radio budget
+    radio = asyncio.Semaphore(RADIO_MAX_INFLIGHT)
+    connect_lock = asyncio.Lock()
+    for i, device in enumerate(devices.values()):
+        client_factory = None
+        if BLE_CAPTURE_PATH:
+            device.gatt.recorder = GattCapture(_device_path(BLE_CAPTURE_PATH, i, device))
+        if BLE_REPLAY_PATH:
+            capture = CaptureIndex(_device_path(BLE_REPLAY_PATH, i, device))
+            client_factory = lambda address, disconnected_callback=None, capture=capture: \
+                ReplayBleakClient(capture, BLE_REPLAY_SPEED, disconnected_callback)
+        tasks.append(asyncio.create_task(
+            run_device(device, radio, connect_lock, i * DEVICE_STAGGER, client_factory)))
     
-    # Cleanup
-    await ble_client.disconnect()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Cleanup
+        for device in devices.values():
+            if device.sensor_data.log is not None:
+                await device.sensor_data.log.close()
+            if device.gatt.recorder is not None:
+                device.gatt.recorder.close()
+            await device.ble.disconnect()
 
+# `python -m bluetooth` starts faster than `python bluetooth.py`: it loads the
+# cached bytecode instead of compiling this file on every start
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())